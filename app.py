@@ -1,10 +1,21 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, after_this_request, request, jsonify, send_from_directory
 from flask_cors import CORS
-import json
+from werkzeug.utils import secure_filename
+import orjson
+import hashlib
 import time
-from datetime import datetime
+import random
+from collections import OrderedDict, defaultdict
+from datetime import date, datetime, timedelta
 import traceback
 import os
+import re
+import shutil
+import sys
+import threading
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from urllib.parse import quote
 
 app = Flask(__name__)
 CORS(app)
@@ -13,227 +24,293 @@ CORS(app)
 DATABASE_URL = os.environ.get('DATABASE_URL')
 USE_POSTGRES = DATABASE_URL is not None
 
+# Connection pool bounds (PostgreSQL only)
+DB_POOL_MIN_CONNECTIONS = 2
+DB_POOL_MAX_CONNECTIONS = 20  # keep at least gunicorn's --threads (see Procfile)
+
 if USE_POSTGRES:
     import psycopg2
-    from psycopg2.extras import RealDictCursor
+    from psycopg2.extras import RealDictCursor, execute_batch, execute_values
+    from psycopg2.errors import DeadlockDetected, SerializationFailure
+    from psycopg2.extensions import connection as PGConnection
+    from psycopg2.pool import ThreadedConnectionPool
+
+    class PooledConnection(PGConnection):
+        """psycopg2 connection that remembers which statements it has prepared"""
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.prepared_statements = set()
+
+    # Deadlocks and serialization failures can succeed on retry
+    RETRYABLE_DB_ERRORS = (DeadlockDetected, SerializationFailure)
+
     # Fix for Render's postgres:// URL (should be postgresql://)
     if DATABASE_URL.startswith('postgres://'):
         DATABASE_URL = DATABASE_URL.replace('postgres://', 'postgresql://', 1)
     print(f"Using PostgreSQL database")
+    # Keep connections open between requests instead of reconnecting every time
+    db_pool = ThreadedConnectionPool(DB_POOL_MIN_CONNECTIONS, DB_POOL_MAX_CONNECTIONS,
+                                     DATABASE_URL, connection_factory=PooledConnection,
+                                     cursor_factory=RealDictCursor)
 else:
     import sqlite3
     DATABASE = 'crm.db'
+    # busy_timeout already waits for a held write lock inside SQLite, so a
+    # "database is locked" error has outlasted it and isn't retried again
+    RETRYABLE_DB_ERRORS = ()
     print(f"Using SQLite database: {DATABASE}")
-
+    # Per-connection tuning: WAL lets readers run alongside a writer, NORMAL sync is
+    # safe under WAL, and a larger page cache / mmap window cuts disk reads.
+    # foreign_keys makes SQLite honour ON DELETE actions like PostgreSQL does.
+    SQLITE_PRAGMAS = [
+        'PRAGMA foreign_keys=ON',
+        'PRAGMA journal_mode=WAL',
+        'PRAGMA synchronous=NORMAL',
+        'PRAGMA temp_store=MEMORY',
+        'PRAGMA mmap_size=268435456',
+        'PRAGMA cache_size=-64000',
+        # Refresh planner statistics that look stale, with a bounded amount of work
+        'PRAGMA optimize=0x10002',
+    ]
+    # Connections live as long as their thread, so statistics are also refreshed
+    # periodically rather than only when a connection closes
+    SQLITE_OPTIMIZE_INTERVAL = 3600  # seconds
+    # Compiled statements kept per connection (sqlite3 defaults to 128)
+    SQLITE_CACHED_STATEMENTS = 256
+    # One long-lived SQLite connection per thread
+    sqlite_local = threading.local()
+
+@contextmanager
 def get_db():
+    """Borrow a database connection for the duration of a with-block"""
     if USE_POSTGRES:
-        conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-        return conn
+        conn = db_pool.getconn()
     else:
-        conn = sqlite3.connect(DATABASE, timeout=60)
-        conn.row_factory = sqlite3.Row
-        return conn
-
+        conn = getattr(sqlite_local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(DATABASE, timeout=60, cached_statements=SQLITE_CACHED_STATEMENTS)
+            conn.row_factory = sqlite3.Row
+            for pragma in SQLITE_PRAGMAS:
+                conn.execute(pragma)
+            sqlite_local.conn = conn
+            sqlite_local.optimized_at = time.monotonic()
+    try:
+        if USE_POSTGRES and len(conn.prepared_statements) < len(PREPARED_STATEMENTS):
+            prepare_statements(conn)
+        yield conn
+    finally:
+        # Throw away anything left uncommitted so the next user starts clean
+        if USE_POSTGRES:
+            try:
+                if not conn.closed:
+                    conn.rollback()
+            except psycopg2.Error:
+                pass
+            db_pool.putconn(conn, close=bool(conn.closed))
+        else:
+            conn.rollback()
+            if time.monotonic() - sqlite_local.optimized_at > SQLITE_OPTIMIZE_INTERVAL:
+                conn.execute('PRAGMA optimize')
+                sqlite_local.optimized_at = time.monotonic()
+
+# SQL strings are literals (or built from a handful of table lists), so the
+# cache stays small and nearly every call is a hit
+@lru_cache(maxsize=256)
 def convert_query(query):
     """Convert SQLite ? placeholders to PostgreSQL %s if needed"""
     if USE_POSTGRES:
         return query.replace('?', '%s')
     return query
 
-def execute_with_retry(func, max_retries=5):
-    """Execute a database function with retry logic for locked database"""
-    for attempt in range(max_retries):
-        try:
-            return func()
-        except Exception as e:
-            # Handle both SQLite and PostgreSQL errors
-            error_str = str(e).lower()
-            is_retryable = "locked" in error_str or "deadlock" in error_str
+# The database is fixed for the life of the process, so dialect differences are
+# resolved once here rather than branching on USE_POSTGRES in every request.
+# INSERT statements end with RETURNING_ID; read the new id with last_insert_id().
+# SQLite understands RETURNING from 3.35 on; older builds report cursor.lastrowid.
+SUPPORTS_RETURNING = USE_POSTGRES or sqlite3.sqlite_version_info >= (3, 35, 0)
 
-            if is_retryable and attempt < max_retries - 1:
-                print(f"Database locked/busy, retrying in {attempt + 1} seconds...")
-                time.sleep(attempt + 1)  # Exponential backoff
-            else:
-                raise
+if SUPPORTS_RETURNING:
+    RETURNING_ID = ' RETURNING id'
 
-def init_db():
-    conn = get_db()
-    c = conn.cursor()
+    def last_insert_id(cursor):
+        return cursor.fetchone()['id']
+else:
+    RETURNING_ID = ''
+
+    def last_insert_id(cursor):
+        return cursor.lastrowid
 
-    # Database-specific setup
+# Fetch the remaining rows as plain dicts. RealDictCursor already builds them;
+# on SQLite, zipping plain tuples with the column names read once is cheaper
+# than building a sqlite3.Row per row and copying it.
+if USE_POSTGRES:
+    def fetch_dicts(cursor):
+        return cursor.fetchall()
+else:
+    def fetch_dicts(cursor):
+        cursor.row_factory = None
+        columns = [column[0] for column in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+        cursor.row_factory = sqlite3.Row
+        return rows
+
+# Hot statements are server-side prepared once per PostgreSQL connection so the
+# server skips parsing and planning them on every call. Maps name -> statement.
+PREPARED_STATEMENTS = {}
+
+def prepared_query(name, query):
+    """Register a ? placeholder query as a prepared statement and return the SQL that runs it.
+
+    On SQLite the query is returned unchanged - sqlite3 already caches compiled
+    statements per connection.
+    """
     if not USE_POSTGRES:
-        # Enable WAL mode for SQLite better concurrency
-        c.execute('PRAGMA journal_mode=WAL')
-        print("WAL mode enabled")
+        return query
+    param_numbers = iter(range(1, query.count('?') + 1))
+    PREPARED_STATEMENTS[name] = re.sub(r'\?', lambda m: f'${next(param_numbers)}', query)
+    if query.count('?') == 0:
+        return f'EXECUTE {name}'
+    return f"EXECUTE {name} ({', '.join(['%s'] * query.count('?'))})"
+
+def prepare_statements(conn):
+    """PREPARE any registered statements this connection doesn't have yet"""
+    c = conn.cursor()
+    for name in PREPARED_STATEMENTS.keys() - conn.prepared_statements:
+        c.execute(f'PREPARE {name} AS {PREPARED_STATEMENTS[name]}')
+        conn.prepared_statements.add(name)
+    conn.commit()
 
-    # Define data types based on database
-    if USE_POSTGRES:
-        pk_type = "SERIAL PRIMARY KEY"
-        timestamp_default = "DEFAULT NOW()"
-    else:
-        pk_type = "INTEGER PRIMARY KEY"
-        timestamp_default = "DEFAULT CURRENT_TIMESTAMP"
-
-    # Companies table
-    c.execute(f'''CREATE TABLE IF NOT EXISTS companies (
-        id {pk_type},
-        name TEXT NOT NULL,
-        website TEXT,
-        industry TEXT,
-        notes TEXT,
-        created_at TIMESTAMP {timestamp_default}
-    )''')
-
-    # Contacts table with new fields
-    c.execute(f'''CREATE TABLE IF NOT EXISTS contacts (
-        id {pk_type},
-        name TEXT NOT NULL,
-        email TEXT,
-        phone TEXT,
-        company TEXT,
-        company_id INTEGER,
-        title TEXT,
-        website TEXT,
-        additional_info TEXT,
-        created_at TIMESTAMP {timestamp_default},
-        FOREIGN KEY(company_id) REFERENCES companies(id)
-    )''')
-
-    # SKU table
-    c.execute(f'''CREATE TABLE IF NOT EXISTS skus (
-        id {pk_type},
-        name TEXT NOT NULL,
-        category TEXT NOT NULL,
-        subcategory TEXT NOT NULL,
-        UNIQUE(name, category, subcategory)
-    )''')
-
-    # Opportunities table - added expected_close_date and closed_revenue
-    c.execute(f'''CREATE TABLE IF NOT EXISTS deals (
-        id {pk_type},
-        name TEXT NOT NULL,
-        contact_id INTEGER,
-        value REAL,
-        probability INTEGER,
-        stage TEXT,
-        status TEXT,
-        lead_source TEXT,
-        budget TEXT,
-        authority TEXT,
-        need TEXT,
-        timeline TEXT,
-        expected_close_date TEXT,
-        closed_revenue REAL DEFAULT 0,
-        created_at TIMESTAMP {timestamp_default},
-        FOREIGN KEY(contact_id) REFERENCES contacts(id)
-    )''')
-
-    # Opportunity-SKU junction table (many-to-many)
-    c.execute(f'''CREATE TABLE IF NOT EXISTS deal_skus (
-        id {pk_type},
-        deal_id INTEGER NOT NULL,
-        sku_id INTEGER NOT NULL,
-        FOREIGN KEY(deal_id) REFERENCES deals(id) ON DELETE CASCADE,
-        FOREIGN KEY(sku_id) REFERENCES skus(id) ON DELETE CASCADE,
-        UNIQUE(deal_id, sku_id)
-    )''')
-
-    # Activities table - added next_steps and due_date
-    c.execute(f'''CREATE TABLE IF NOT EXISTS activities (
-        id {pk_type},
-        deal_id INTEGER,
-        contact_id INTEGER,
-        type TEXT,
-        description TEXT,
-        next_steps TEXT,
-        due_date DATE,
-        created_at TIMESTAMP {timestamp_default},
-        FOREIGN KEY(deal_id) REFERENCES deals(id),
-        FOREIGN KEY(contact_id) REFERENCES contacts(id)
-    )''')
-
-    # Tasks table - standalone tasks not tied to deals
-    c.execute(f'''CREATE TABLE IF NOT EXISTS tasks (
-        id {pk_type},
-        name TEXT NOT NULL,
-        detail TEXT,
-        due_date DATE,
-        completed BOOLEAN DEFAULT FALSE,
-        priority TEXT,
-        category TEXT,
-        assignee TEXT,
-        recurring TEXT,
-        created_at TIMESTAMP {timestamp_default}
-    )''')
-
-    # Documents table - file uploads and external links
-    c.execute(f'''CREATE TABLE IF NOT EXISTS documents (
-        id {pk_type},
-        name TEXT NOT NULL,
-        description TEXT,
-        file_path TEXT,
-        external_link TEXT,
-        file_size INTEGER,
-        file_type TEXT,
-        document_category TEXT,
-        version TEXT,
-        expiration_date DATE,
-        tags TEXT,
-        company_id INTEGER,
-        deal_id INTEGER,
-        uploaded_by TEXT,
-        created_at TIMESTAMP {timestamp_default},
-        FOREIGN KEY(company_id) REFERENCES companies(id),
-        FOREIGN KEY(deal_id) REFERENCES deals(id)
-    )''')
-
-    # Settings table for annual goal and other configuration
-    c.execute(f'''CREATE TABLE IF NOT EXISTS settings (
-        id {pk_type},
-        key TEXT NOT NULL UNIQUE,
-        value TEXT NOT NULL,
-        updated_at TIMESTAMP {timestamp_default}
-    )''')
-
-    # Insert default annual goal if not exists
-    if USE_POSTGRES:
-        c.execute('''
-            INSERT INTO settings (key, value)
-            VALUES (%s, %s)
-            ON CONFLICT (key) DO NOTHING
-        ''', ('annual_goal', '1000000'))
+def _json_default(obj):
+    """Fallback for values orjson can't serialize natively"""
+    if not USE_POSTGRES and isinstance(obj, sqlite3.Row):
+        return dict(obj)
+    return str(obj)
+
+def json_body(data):
+    """Serialize with orjson; rows from either driver can be passed as-is"""
+    return orjson.dumps(data, default=_json_default, option=orjson.OPT_NAIVE_UTC)
+
+def json_response(data, status=200):
+    """JSON response for data, or for a body already encoded with json_body()"""
+    body = data if isinstance(data, bytes) else json_body(data)
+    return app.response_class(body, status=status, mimetype='application/json')
+
+# Tables whose list endpoints answer conditional GETs. Writes to them must call
+# bump_table_versions() in the same transaction so cached copies get invalidated.
+VERSIONED_TABLES = ('contacts', 'companies', 'deals', 'settings')
+
+def bump_table_versions(cursor, *tables):
+    """Mark tables as changed so clients holding an old ETag refetch"""
+    placeholders = ','.join(['?'] * len(tables))
+    cursor.execute(convert_query(f'UPDATE table_versions SET version = version + 1 WHERE table_name IN ({placeholders})'),
+                   tables)
+
+def table_versions_etag(cursor, *tables):
+    """ETag derived from the change counters of the tables a response is built from"""
+    placeholders = ','.join(['?'] * len(tables))
+    cursor.execute(convert_query(f'SELECT table_name, version FROM table_versions WHERE table_name IN ({placeholders})'),
+                   tables)
+    versions = sorted((row['table_name'], row['version']) for row in cursor.fetchall())
+    return hashlib.md5(repr(versions).encode()).hexdigest()
+
+# Encoded dashboard payloads, reused until a table they are built from changes.
+# Keyed on table versions rather than time, so every worker sees writes at once.
+response_cache = {}
+
+def cached_payload(cursor, key, etag, build):
+    """Return the JSON body of build(cursor), reusing the last one while the tables' etag is unchanged"""
+    cached = response_cache.get(key)
+    if cached is not None and cached[0] == etag:
+        return cached[1]
+    body = json_body(build(cursor))
+    response_cache[key] = (etag, body)
+    return body
+
+def etag_response(etag, data):
+    """JSON response tagged with etag, or 304 Not Modified when data is None"""
+    if data is None:
+        response = app.response_class(status=304)
     else:
-        c.execute('''
-            INSERT OR IGNORE INTO settings (key, value)
-            VALUES (?, ?)
-        ''', ('annual_goal', '1000000'))
+        response = json_response(data)
+    response.set_etag(etag)
+    # Let the browser keep a copy but check the ETag before every reuse
+    response.cache_control.no_cache = True
+    return response
+
+# Retry tuning: backoff scales with how long database calls normally take,
+# capped so a retry never parks a worker thread for long
+RETRY_MAX_DELAY = 0.05  # seconds
+RETRY_JITTER = 0.005  # seconds
+avg_query_seconds = 0.001  # moving average of successful database calls
+
+def execute_with_retry(func, *args, max_retries=5, **kwargs):
+    """Call func(*args, **kwargs), retrying it after a transaction conflict"""
+    global avg_query_seconds
+    for attempt in range(max_retries):
+        try:
+            started = time.perf_counter()
+            result = func(*args, **kwargs)
+            avg_query_seconds = 0.9 * avg_query_seconds + 0.1 * (time.perf_counter() - started)
+            return result
+        except RETRYABLE_DB_ERRORS:
+            # Anything else propagates straight away. The failed attempt's
+            # transaction was rolled back, so running it again is safe.
+            if attempt == max_retries - 1:
+                raise
+            # Exponential backoff with jitter so retrying requests don't collide again
+            delay = min(RETRY_MAX_DELAY, avg_query_seconds * 2 ** attempt) + random.random() * RETRY_JITTER
+            print(f"Transaction conflict, retrying in {delay * 1000:.1f} ms...")
+            time.sleep(delay)
+
+def begin_write(conn):
+    """Open a write transaction explicitly on SQLite.
+
+    sqlite3 only starts transactions implicitly before INSERT/UPDATE/DELETE, so
+    DDL and leading reads would otherwise run (and sync) one statement at a
+    time. psycopg2 already opens a transaction with the first statement.
+    """
+    if not USE_POSTGRES:
+        conn.execute('BEGIN IMMEDIATE')
+
+def run_in_transaction(func, *args, **kwargs):
+    """Call func(conn, *args, **kwargs) on a pooled connection and commit once"""
+    with get_db() as conn:
+        if request.method not in ('GET', 'HEAD'):
+            # One write transaction for the whole handler. Taking SQLite's
+            # lock up front waits out busy_timeout instead of failing when a
+            # read-then-write handler tries to upgrade its lock.
+            begin_write(conn)
+        response = func(conn, *args, **kwargs)
+        conn.commit()
+        return response
+
+def db_endpoint(func):
+    """Run an endpoint with a pooled connection, retrying on transaction conflicts,
+    committing once on success and turning failures into a JSON 500"""
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return execute_with_retry(run_in_transaction, func, *args, **kwargs)
+        except Exception as e:
+            print(f"Error in {func.__name__}: {e}")
+            traceback.print_exc()
+            return jsonify({'error': str(e)}), 500
+    return wrapper
 
-    conn.commit()
-    conn.close()
-    print("Database initialized successfully")
+def init_db():
+    with get_db() as conn:
+        begin_write(conn)
+        c = conn.cursor()
 
-def migrate_db():
-    """Add new columns if they don't exist - comprehensive migration"""
-    conn = get_db()
-    c = conn.cursor()
+        # Define data types based on database
+        if USE_POSTGRES:
+            pk_type = "SERIAL PRIMARY KEY"
+            timestamp_default = "DEFAULT NOW()"
+        else:
+            pk_type = "INTEGER PRIMARY KEY"
+            timestamp_default = "DEFAULT CURRENT_TIMESTAMP"
 
-    # Ensure companies table exists (for old databases)
-    if USE_POSTGRES:
-        c.execute("""
-            SELECT COUNT(*) as count FROM information_schema.tables
-            WHERE table_name = 'companies'
-        """)
-        result = c.fetchone()
-        companies_exists = result['count'] > 0 if result else False
-    else:
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='companies'")
-        companies_exists = c.fetchone() is not None
-
-    if not companies_exists:
-        print("Creating companies table...")
-        pk_type = "SERIAL PRIMARY KEY" if USE_POSTGRES else "INTEGER PRIMARY KEY"
-        timestamp_default = "DEFAULT NOW()" if USE_POSTGRES else "DEFAULT CURRENT_TIMESTAMP"
-        c.execute(f'''CREATE TABLE companies (
+        # Companies table
+        c.execute(f'''CREATE TABLE IF NOT EXISTS companies (
             id {pk_type},
             name TEXT NOT NULL,
             website TEXT,
@@ -241,1492 +318,1424 @@ def migrate_db():
             notes TEXT,
             created_at TIMESTAMP {timestamp_default}
         )''')
-        print("Companies table created")
 
-    # Get existing columns in contacts table
-    if USE_POSTGRES:
-        c.execute("""
-            SELECT column_name FROM information_schema.columns
-            WHERE table_name = 'contacts'
-        """)
-        contacts_columns = [row['column_name'] for row in c.fetchall()]
-    else:
-        c.execute("PRAGMA table_info(contacts)")
-        contacts_columns = [row[1] for row in c.fetchall()]
+        # Contacts table with new fields
+        c.execute(f'''CREATE TABLE IF NOT EXISTS contacts (
+            id {pk_type},
+            name TEXT NOT NULL,
+            email TEXT,
+            phone TEXT,
+            company TEXT,
+            company_id INTEGER,
+            title TEXT,
+            website TEXT,
+            additional_info TEXT,
+            created_at TIMESTAMP {timestamp_default},
+            FOREIGN KEY(company_id) REFERENCES companies(id) ON DELETE SET NULL
+        )''')
 
-    print(f"Existing contacts columns: {contacts_columns}")
+        # SKU table
+        c.execute(f'''CREATE TABLE IF NOT EXISTS skus (
+            id {pk_type},
+            name TEXT NOT NULL,
+            category TEXT NOT NULL,
+            subcategory TEXT NOT NULL,
+            UNIQUE(name, category, subcategory)
+        )''')
 
-    # Add missing columns to contacts
-    contacts_migrations = [
-        ("title", "TEXT"),
-        ("website", "TEXT"),
-        ("additional_info", "TEXT"),
-        ("company_id", "INTEGER"),
-    ]
+        # Opportunities table - added expected_close_date and closed_revenue
+        c.execute(f'''CREATE TABLE IF NOT EXISTS deals (
+            id {pk_type},
+            name TEXT NOT NULL,
+            contact_id INTEGER,
+            value REAL,
+            probability INTEGER,
+            stage TEXT,
+            status TEXT,
+            lead_source TEXT,
+            budget TEXT,
+            authority TEXT,
+            need TEXT,
+            timeline TEXT,
+            expected_close_date TEXT,
+            closed_revenue REAL DEFAULT 0,
+            created_at TIMESTAMP {timestamp_default},
+            FOREIGN KEY(contact_id) REFERENCES contacts(id) ON DELETE SET NULL
+        )''')
 
-    for col_name, col_type in contacts_migrations:
-        if col_name not in contacts_columns:
-            try:
-                c.execute(f"ALTER TABLE contacts ADD COLUMN {col_name} {col_type}")
-                print(f"Added column {col_name} to contacts")
-            except Exception as e:
-                print(f"Error adding {col_name} to contacts: {e}")
-    
-    # Get existing columns in deals table
-    if USE_POSTGRES:
-        c.execute("""
-            SELECT column_name FROM information_schema.columns
-            WHERE table_name = 'deals'
-        """)
-        deals_columns = [row['column_name'] for row in c.fetchall()]
-    else:
-        c.execute("PRAGMA table_info(deals)")
-        deals_columns = [row[1] for row in c.fetchall()]
+        # Opportunity-SKU junction table (many-to-many)
+        c.execute(f'''CREATE TABLE IF NOT EXISTS deal_skus (
+            id {pk_type},
+            deal_id INTEGER NOT NULL,
+            sku_id INTEGER NOT NULL,
+            FOREIGN KEY(deal_id) REFERENCES deals(id) ON DELETE CASCADE,
+            FOREIGN KEY(sku_id) REFERENCES skus(id) ON DELETE CASCADE,
+            UNIQUE(deal_id, sku_id)
+        )''')
 
-    print(f"Existing deals columns: {deals_columns}")
-    
-    # Add missing columns to deals
-    deals_migrations = [
-        ("name", "TEXT"),
-        ("contact_id", "INTEGER"),
-        ("value", "REAL"),
-        ("probability", "INTEGER"),
-        ("closed_revenue", "REAL DEFAULT 0"),
-        ("stage", "TEXT"),
-        ("status", "TEXT"),
-        ("lead_source", "TEXT"),
-        ("budget", "TEXT"),
-        ("authority", "TEXT"),
-        ("need", "TEXT"),
-        ("timeline", "TEXT"),
-        ("expected_close_date", "TEXT"),
-    ]
-    
-    for col_name, col_type in deals_migrations:
-        if col_name not in deals_columns:
-            try:
-                c.execute(f"ALTER TABLE deals ADD COLUMN {col_name} {col_type}")
-                print(f"Added column {col_name} to deals")
-            except Exception as e:
-                print(f"Error adding {col_name} to deals: {e}")
-    
-    # Get existing columns in activities table
-    if USE_POSTGRES:
-        c.execute("""
-            SELECT column_name FROM information_schema.columns
-            WHERE table_name = 'activities'
-        """)
-        activities_columns = [row['column_name'] for row in c.fetchall()]
-    else:
-        c.execute("PRAGMA table_info(activities)")
-        activities_columns = [row[1] for row in c.fetchall()]
+        # Activities table - added next_steps and due_date
+        c.execute(f'''CREATE TABLE IF NOT EXISTS activities (
+            id {pk_type},
+            deal_id INTEGER,
+            contact_id INTEGER,
+            type TEXT,
+            description TEXT,
+            next_steps TEXT,
+            due_date DATE,
+            created_at TIMESTAMP {timestamp_default},
+            FOREIGN KEY(deal_id) REFERENCES deals(id) ON DELETE CASCADE,
+            FOREIGN KEY(contact_id) REFERENCES contacts(id) ON DELETE SET NULL
+        )''')
 
-    print(f"Existing activities columns: {activities_columns}")
-    
-    # Add missing columns to activities
-    activities_migrations = [
-        ("next_steps", "TEXT"),
-        ("due_date", "DATE"),
-    ]
-    
-    for col_name, col_type in activities_migrations:
-        if col_name not in activities_columns:
-            try:
-                c.execute(f"ALTER TABLE activities ADD COLUMN {col_name} {col_type}")
-                print(f"Added column {col_name} to activities")
-            except Exception as e:
-                print(f"Error adding {col_name} to activities: {e}")
+        # Tasks table - standalone tasks not tied to deals
+        c.execute(f'''CREATE TABLE IF NOT EXISTS tasks (
+            id {pk_type},
+            name TEXT NOT NULL,
+            detail TEXT,
+            due_date DATE,
+            completed BOOLEAN DEFAULT FALSE,
+            priority TEXT,
+            category TEXT,
+            assignee TEXT,
+            recurring TEXT,
+            created_at TIMESTAMP {timestamp_default}
+        )''')
 
-    # Migrate existing contact data: extract company names and link contacts to companies
-    print("Migrating contact company data to companies table...")
+        # Documents table - file uploads and external links
+        c.execute(f'''CREATE TABLE IF NOT EXISTS documents (
+            id {pk_type},
+            name TEXT NOT NULL,
+            description TEXT,
+            file_path TEXT,
+            external_link TEXT,
+            file_size INTEGER,
+            file_type TEXT,
+            document_category TEXT,
+            version TEXT,
+            expiration_date DATE,
+            tags TEXT,
+            company_id INTEGER,
+            deal_id INTEGER,
+            uploaded_by TEXT,
+            created_at TIMESTAMP {timestamp_default},
+            FOREIGN KEY(company_id) REFERENCES companies(id) ON DELETE SET NULL,
+            FOREIGN KEY(deal_id) REFERENCES deals(id) ON DELETE SET NULL
+        )''')
 
-    # Get all contacts with company names that don't have company_id set
-    if USE_POSTGRES:
-        c.execute('SELECT id, company FROM contacts WHERE company IS NOT NULL AND company != %s AND company_id IS NULL', ('',))
-    else:
-        c.execute('SELECT id, company FROM contacts WHERE company IS NOT NULL AND company != ? AND company_id IS NULL', ('',))
+        # Settings table for annual goal and other configuration
+        c.execute(f'''CREATE TABLE IF NOT EXISTS settings (
+            id {pk_type},
+            key TEXT NOT NULL UNIQUE,
+            value TEXT NOT NULL,
+            updated_at TIMESTAMP {timestamp_default}
+        )''')
 
-    contacts_with_companies = c.fetchall()
-    print(f"Found {len(contacts_with_companies)} contacts with company names to migrate")
+        # Insert default annual goal if not exists
+        if USE_POSTGRES:
+            c.execute('''
+                INSERT INTO settings (key, value)
+                VALUES (%s, %s)
+                ON CONFLICT (key) DO NOTHING
+            ''', ('annual_goal', '1000000'))
+        else:
+            c.execute('''
+                INSERT OR IGNORE INTO settings (key, value)
+                VALUES (?, ?)
+            ''', ('annual_goal', '1000000'))
+
+        # Change counters behind the ETags on list endpoints
+        c.execute('''CREATE TABLE IF NOT EXISTS table_versions (
+            table_name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )''')
+        if USE_POSTGRES:
+            execute_values(c, 'INSERT INTO table_versions (table_name) VALUES %s ON CONFLICT DO NOTHING',
+                           [(table,) for table in VERSIONED_TABLES])
+        else:
+            c.executemany('INSERT OR IGNORE INTO table_versions (table_name) VALUES (?)',
+                          [(table,) for table in VERSIONED_TABLES])
+
+        conn.commit()
+    print("Database initialized successfully")
+
+def migrate_db():
+    """Add new columns if they don't exist - comprehensive migration"""
+    with get_db() as conn:
+        begin_write(conn)
+        c = conn.cursor()
+
+        # Columns added since each table was first created
+        column_migrations = {
+            'contacts': [
+                ("title", "TEXT"),
+                ("website", "TEXT"),
+                ("additional_info", "TEXT"),
+                ("company_id", "INTEGER"),
+            ],
+            'deals': [
+                ("name", "TEXT"),
+                ("contact_id", "INTEGER"),
+                ("value", "REAL"),
+                ("probability", "INTEGER"),
+                ("closed_revenue", "REAL DEFAULT 0"),
+                ("stage", "TEXT"),
+                ("status", "TEXT"),
+                ("lead_source", "TEXT"),
+                ("budget", "TEXT"),
+                ("authority", "TEXT"),
+                ("need", "TEXT"),
+                ("timeline", "TEXT"),
+                ("expected_close_date", "TEXT"),
+            ],
+            'activities': [
+                ("next_steps", "TEXT"),
+                ("due_date", "DATE"),
+            ],
+        }
+
+        # (table, column, referenced table, ON DELETE action) as declared by init_db
+        foreign_key_actions = [
+            ('contacts', 'company_id', 'companies', 'SET NULL'),
+            ('deals', 'contact_id', 'contacts', 'SET NULL'),
+            ('activities', 'deal_id', 'deals', 'CASCADE'),
+            ('activities', 'contact_id', 'contacts', 'SET NULL'),
+            ('documents', 'company_id', 'companies', 'SET NULL'),
+            ('documents', 'deal_id', 'deals', 'SET NULL'),
+        ]
 
-    # Track unique company names and their IDs
-    company_map = {}
+        if USE_POSTGRES:
+            # One ALTER per table; IF NOT EXISTS skips columns that are already there
+            for table, migrations in column_migrations.items():
+                clauses = ', '.join(f"ADD COLUMN IF NOT EXISTS {col_name} {col_type}"
+                                    for col_name, col_type in migrations)
+                c.execute(f"ALTER TABLE {table} {clauses}")
+
+            # Databases created before init_db declared ON DELETE actions have plain
+            # foreign keys, or none on columns added above. Redeclare them so the
+            # database unlinks and cascades deletes itself. Orphaned references
+            # would fail validation, so they are cleared first.
+            for table, column, parent, action in foreign_key_actions:
+                constraint = f"{table}_{column}_fkey"
+                c.execute(f"""UPDATE {table} SET {column} = NULL
+                              WHERE {column} IS NOT NULL
+                              AND NOT EXISTS (SELECT 1 FROM {parent} p WHERE p.id = {table}.{column})""")
+                c.execute(f"""ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {constraint},
+                              ADD CONSTRAINT {constraint} FOREIGN KEY ({column})
+                              REFERENCES {parent}(id) ON DELETE {action}""")
+        else:
+            # SQLite has no ADD COLUMN IF NOT EXISTS, so read the existing columns of
+            # every table we care about in one query and add only the missing ones
+            placeholders = ','.join(['?'] * len(column_migrations))
+            c.execute(f"""
+                SELECT m.name as table_name, p.name as column_name
+                FROM sqlite_master m, pragma_table_info(m.name) p
+                WHERE m.type = 'table' AND m.name IN ({placeholders})
+            """, list(column_migrations))
+            existing_columns = defaultdict(set)
+            for row in c.fetchall():
+                existing_columns[row['table_name']].add(row['column_name'])
+
+            for table, migrations in column_migrations.items():
+                for col_name, col_type in migrations:
+                    if col_name not in existing_columns[table]:
+                        c.execute(f"ALTER TABLE {table} ADD COLUMN {col_name} {col_type}")
+                        print(f"Added column {col_name} to {table}")
+
+        conn.commit()
+    print("Migration complete!")
 
-    for contact in contacts_with_companies:
-        contact_id = contact['id']
-        company_name = contact['company'].strip()
+def link_contact_companies():
+    """Link contacts that only carry a company name to a companies row"""
+    with get_db() as conn:
+        begin_write(conn)
+        c = conn.cursor()
 
-        # Skip empty company names
-        if not company_name:
-            continue
+        # Migrate existing contact data: extract company names and link contacts to companies
+        print("Migrating contact company data to companies table...")
 
-        # Check if we already created this company in this migration
-        if company_name in company_map:
-            company_id = company_map[company_name]
+        # Get all contacts with company names that don't have company_id set
+        if USE_POSTGRES:
+            c.execute('SELECT id, company FROM contacts WHERE company IS NOT NULL AND company != %s AND company_id IS NULL', ('',))
         else:
-            # Check if company already exists in database
-            if USE_POSTGRES:
-                c.execute('SELECT id FROM companies WHERE name = %s', (company_name,))
-            else:
-                c.execute('SELECT id FROM companies WHERE name = ?', (company_name,))
+            c.execute('SELECT id, company FROM contacts WHERE company IS NOT NULL AND company != ? AND company_id IS NULL', ('',))
 
-            existing_company = c.fetchone()
+        contacts_with_companies = c.fetchall()
+        print(f"Found {len(contacts_with_companies)} contacts with company names to migrate")
 
-            if existing_company:
-                company_id = existing_company['id']
-            else:
-                # Create new company
+        # Track unique company names and their IDs
+        company_map = {}
+
+        # Pair each contact with its trimmed company name, skipping empty names
+        contact_companies = [(contact['id'], contact['company'].strip())
+                             for contact in contacts_with_companies
+                             if contact['company'].strip()]
+
+        if contact_companies:
+            # Load existing companies once instead of looking each name up
+            c.execute('SELECT id, name FROM companies ORDER BY id')
+            for company in c.fetchall():
+                company_map.setdefault(company['name'], company['id'])
+
+            # Create all missing companies in one batch
+            new_names = sorted({name for _, name in contact_companies if name not in company_map})
+            if new_names:
                 if USE_POSTGRES:
-                    c.execute('INSERT INTO companies (name) VALUES (%s) RETURNING id', (company_name,))
-                    company_id = c.fetchone()['id']
+                    created = execute_values(c, 'INSERT INTO companies (name) VALUES %s RETURNING id, name',
+                                             [(name,) for name in new_names], fetch=True)
+                    for company in created:
+                        company_map[company['name']] = company['id']
                 else:
-                    c.execute('INSERT INTO companies (name) VALUES (?)', (company_name,))
-                    company_id = c.lastrowid
+                    c.executemany('INSERT INTO companies (name) VALUES (?)', [(name,) for name in new_names])
+                    placeholders = ','.join(['?'] * len(new_names))
+                    c.execute(f'SELECT id, name FROM companies WHERE name IN ({placeholders}) ORDER BY id', new_names)
+                    for company in c.fetchall():
+                        company_map.setdefault(company['name'], company['id'])
+                print(f"Created {len(new_names)} companies: {', '.join(new_names)}")
+
+            # Link all contacts to their companies in one batch
+            links = [(company_map[name], contact_id) for contact_id, name in contact_companies]
+            if USE_POSTGRES:
+                execute_batch(c, 'UPDATE contacts SET company_id = %s WHERE id = %s', links)
+            else:
+                c.executemany('UPDATE contacts SET company_id = ? WHERE id = ?', links)
+            bump_table_versions(c, 'contacts', 'companies')
 
-                print(f"Created company: {company_name} (ID: {company_id})")
+        linked_companies = {name for _, name in contact_companies}
+        print(f"Migrated {len(contacts_with_companies)} contacts to {len(linked_companies)} companies")
 
-            company_map[company_name] = company_id
+        conn.commit()
 
-        # Link contact to company
-        if USE_POSTGRES:
-            c.execute('UPDATE contacts SET company_id = %s WHERE id = %s', (company_id, contact_id))
-        else:
-            c.execute('UPDATE contacts SET company_id = ? WHERE id = ?', (company_id, contact_id))
+def create_indexes():
+    """Index the foreign-key and sort columns used by the list endpoints.
 
-    print(f"Migrated {len(contacts_with_companies)} contacts to {len(company_map)} companies")
+    Runs after migrate_db() so columns added by migrations already exist.
+    deal_skus(deal_id) is already covered by its UNIQUE(deal_id, sku_id) index.
+    """
+    if USE_POSTGRES:
+        # Covering index so company contact lists can be read from the index alone
+        contacts_company_index = 'CREATE INDEX IF NOT EXISTS idx_contacts_company_id ON contacts(company_id) INCLUDE (name)'
+    else:
+        contacts_company_index = 'CREATE INDEX IF NOT EXISTS idx_contacts_company_id ON contacts(company_id)'
+
+    indexes = [
+        contacts_company_index,
+        'CREATE INDEX IF NOT EXISTS idx_contacts_name ON contacts(name)',
+        'CREATE INDEX IF NOT EXISTS idx_deals_contact_id ON deals(contact_id)',
+        # Open-deal dashboards filter on status, then group by stage or sort by close date
+        'CREATE INDEX IF NOT EXISTS idx_deals_status_stage ON deals(status, stage)',
+        'CREATE INDEX IF NOT EXISTS idx_deals_status_close ON deals(status, expected_close_date)',
+        'CREATE INDEX IF NOT EXISTS idx_activities_deal_id ON activities(deal_id)',
+        'CREATE INDEX IF NOT EXISTS idx_activities_due_date ON activities(due_date)',
+        # The this-week widget reads open tasks by due date; the task list sorts the same way
+        'DROP INDEX IF EXISTS idx_tasks_due_date',
+        'CREATE INDEX IF NOT EXISTS idx_tasks_completed_due ON tasks(completed, due_date)',
+        # Child sides of ON DELETE actions, so deleting a parent doesn't scan these tables
+        'CREATE INDEX IF NOT EXISTS idx_deal_skus_sku_id ON deal_skus(sku_id)',
+        'CREATE INDEX IF NOT EXISTS idx_activities_contact_id ON activities(contact_id)',
+        'CREATE INDEX IF NOT EXISTS idx_documents_company_id ON documents(company_id)',
+        'CREATE INDEX IF NOT EXISTS idx_documents_deal_id ON documents(deal_id)',
+    ]
 
-    conn.commit()
-    conn.close()
-    print("Migration complete!")
+    with get_db() as conn:
+        begin_write(conn)
+        c = conn.cursor()
+        for index_sql in indexes:
+            c.execute(index_sql)
+        conn.commit()
+    print("Indexes created successfully")
 
 def populate_skus():
     """Populate SKU table with predefined values"""
-    conn = get_db()
-    c = conn.cursor()
-    
-    skus = [
-        # Raw Materials - Fiber
-        ('Premium Clean Long Fiber', 'Raw Materials', 'Fiber'),
-        ('Non-woven Grade, Clean Fiber', 'Raw Materials', 'Fiber'),
-        ('Short Fiber/Hurd Mix', 'Raw Materials', 'Fiber'),
-        # Raw Materials - Hurd
-        ('H1 Hurd - 3/4"', 'Raw Materials', 'Hurd'),
-        ('H2 Hurd - 1/2"', 'Raw Materials', 'Hurd'),
-        ('H3 Hurd - 1/16"', 'Raw Materials', 'Hurd'),
-        # Products - Insulation
-        ('2"x24"x48"', 'Products', 'Insulation'),
-        ('3.5"x24"x48"', 'Products', 'Insulation'),
-        ('5.5"x24"x48"', 'Products', 'Insulation'),
-        ('7.5"x24"x48"', 'Products', 'Insulation'),
-        # Products - Acoustic Panels
-        ('1"x24"x48"', 'Products', 'Acoustic Panels'),
-        ('2"x24"x48"', 'Products', 'Acoustic Panels'),
-        ('4"x24"x48"', 'Products', 'Acoustic Panels'),
-    ]
+    global sku_cache
+    with get_db() as conn:
+        begin_write(conn)
+        c = conn.cursor()
     
-    for sku_name, category, subcategory in skus:
-        try:
-            if USE_POSTGRES:
-                c.execute('INSERT INTO skus (name, category, subcategory) VALUES (%s, %s, %s)',
-                         (sku_name, category, subcategory))
-            else:
-                c.execute('INSERT INTO skus (name, category, subcategory) VALUES (?, ?, ?)',
-                         (sku_name, category, subcategory))
-        except Exception:
-            pass  # SKU already exists (IntegrityError for both SQLite and PostgreSQL)
+        skus = [
+            # Raw Materials - Fiber
+            ('Premium Clean Long Fiber', 'Raw Materials', 'Fiber'),
+            ('Non-woven Grade, Clean Fiber', 'Raw Materials', 'Fiber'),
+            ('Short Fiber/Hurd Mix', 'Raw Materials', 'Fiber'),
+            # Raw Materials - Hurd
+            ('H1 Hurd - 3/4"', 'Raw Materials', 'Hurd'),
+            ('H2 Hurd - 1/2"', 'Raw Materials', 'Hurd'),
+            ('H3 Hurd - 1/16"', 'Raw Materials', 'Hurd'),
+            # Products - Insulation
+            ('2"x24"x48"', 'Products', 'Insulation'),
+            ('3.5"x24"x48"', 'Products', 'Insulation'),
+            ('5.5"x24"x48"', 'Products', 'Insulation'),
+            ('7.5"x24"x48"', 'Products', 'Insulation'),
+            # Products - Acoustic Panels
+            ('1"x24"x48"', 'Products', 'Acoustic Panels'),
+            ('2"x24"x48"', 'Products', 'Acoustic Panels'),
+            ('4"x24"x48"', 'Products', 'Acoustic Panels'),
+        ]
     
-    conn.commit()
-    conn.close()
+        # Insert all SKUs in one statement, skipping ones that already exist
+        if USE_POSTGRES:
+            execute_values(c, 'INSERT INTO skus (name, category, subcategory) VALUES %s ON CONFLICT DO NOTHING',
+                           skus)
+        else:
+            c.executemany('INSERT OR IGNORE INTO skus (name, category, subcategory) VALUES (?, ?, ?)',
+                          skus)
+
+        conn.commit()
+    sku_cache = None
     print("SKUs populated successfully")
 
-# Initialize database on first request
+# Initialize database once per process, at import time
 db_initialized = False
 
+# Bump whenever init_db, migrate_db, create_indexes or the SKU catalogue change
+SCHEMA_VERSION = 3
+db_init_lock = threading.Lock()
+
+# Arbitrary key for the advisory lock held while the schema is set up
+SCHEMA_LOCK_KEY = 7296513
+
+@contextmanager
+def schema_lock():
+    """Serialize schema setup across worker processes sharing one database"""
+    if not USE_POSTGRES:
+        # Each setup step holds SQLite's write lock, which serializes the DDL
+        yield
+        return
+    with get_db() as conn:
+        # Released when get_db rolls the transaction back
+        conn.cursor().execute('SELECT pg_advisory_xact_lock(%s)', (SCHEMA_LOCK_KEY,))
+        yield
+
+def stored_schema_version():
+    """Schema version recorded by the last completed setup, 0 if there is none"""
+    with get_db() as conn:
+        c = conn.cursor()
+        if USE_POSTGRES:
+            c.execute("SELECT to_regclass('settings') IS NOT NULL as present")
+        else:
+            c.execute("SELECT COUNT(*) as present FROM sqlite_master WHERE type = 'table' AND name = 'settings'")
+        if not c.fetchone()['present']:
+            return 0
+        c.execute(convert_query('SELECT value FROM settings WHERE key = ?'), ('schema_version',))
+        row = c.fetchone()
+        return int(row['value']) if row else 0
+
+def record_schema_version():
+    with get_db() as conn:
+        begin_write(conn)
+        conn.cursor().execute(convert_query('''INSERT INTO settings (key, value) VALUES (?, ?)
+                                               ON CONFLICT (key) DO UPDATE SET value = excluded.value'''),
+                              ('schema_version', str(SCHEMA_VERSION)))
+        conn.commit()
+
 def ensure_db_initialized():
     global db_initialized
-    if not db_initialized:
+    if db_initialized:
+        return
+    with db_init_lock:
+        # Another thread may have finished while we waited for the lock
+        if db_initialized:
+            return
         try:
             print("Starting database initialization...")
-            init_db()
-            migrate_db()
-            populate_skus()
+            with schema_lock():
+                # Tables, columns, indexes and SKUs only change with SCHEMA_VERSION
+                if stored_schema_version() < SCHEMA_VERSION:
+                    init_db()
+                    migrate_db()
+                    create_indexes()
+                    populate_skus()
+                    record_schema_version()
+                link_contact_companies()
             print("Database setup complete!")
             db_initialized = True
         except Exception as e:
             print(f"Error initializing database: {e}")
             raise
 
+ensure_db_initialized()
+
 # ==================== CONTACTS ENDPOINTS ====================
 
-@app.route('/api/contacts', methods=['GET'])
-def get_contacts():
-    def do_get():
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            # Include company name in contact data
-            c.execute('''
-                SELECT c.*, co.name as company_name
-                FROM contacts c
-                LEFT JOIN companies co ON c.company_id = co.id
-                ORDER BY c.name
-            ''')
-            contacts = c.fetchall()
-            return [dict(contact) for contact in contacts]
-        finally:
-            conn.close()
+SQL_INSERT_CONTACT = prepared_query('insert_contact',
+                                    '''INSERT INTO contacts (name, email, phone, company, company_id, title, website, additional_info)
+                                       VALUES (?, ?, ?, ?, ?, ?, ?, ?)''' + RETURNING_ID)
+SQL_UPDATE_CONTACT = prepared_query('update_contact',
+                                    '''UPDATE contacts
+                                       SET name=?, email=?, phone=?, company=?, company_id=?, title=?, website=?, additional_info=?
+                                       WHERE id=?''')
 
-    try:
-        contacts = execute_with_retry(do_get)
-        return jsonify(contacts)
-    except Exception as e:
-        print(f"Error in get_contacts: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@app.route('/api/contacts', methods=['GET'])
+@db_endpoint
+def get_contacts(conn):
+    c = conn.cursor()
+    etag = table_versions_etag(c, 'contacts', 'companies')
+    if request.if_none_match.contains(etag):
+        return etag_response(etag, None)
+    # Include company name in contact data
+    c.execute('''
+        SELECT c.id, c.name, c.email, c.phone, c.company, c.company_id, c.title,
+               c.website, c.additional_info, co.name as company_name
+        FROM contacts c
+        LEFT JOIN companies co ON c.company_id = co.id
+        ORDER BY c.name
+    ''')
+    return etag_response(etag, fetch_dicts(c))
 
 @app.route('/api/contacts', methods=['POST'])
-def add_contact():
-    def do_add():
-        data = request.json
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            if USE_POSTGRES:
-                c.execute('''INSERT INTO contacts (name, email, phone, company, company_id, title, website, additional_info)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id''',
-                         (data.get('name'), data.get('email'), data.get('phone'),
-                          data.get('company'), data.get('company_id'), data.get('title'), data.get('website'),
-                          data.get('additional_info')))
-                contact_id = c.fetchone()['id']
-            else:
-                c.execute('''INSERT INTO contacts (name, email, phone, company, company_id, title, website, additional_info)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                         (data.get('name'), data.get('email'), data.get('phone'),
-                          data.get('company'), data.get('company_id'), data.get('title'), data.get('website'),
-                          data.get('additional_info')))
-                contact_id = c.lastrowid
-            conn.commit()
-            return contact_id
-        finally:
-            conn.close()
-
-    try:
-        contact_id = execute_with_retry(do_add)
-        return jsonify({'id': contact_id}), 201
-    except Exception as e:
-        print(f"Error in add_contact: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@db_endpoint
+def add_contact(conn):
+    data = request.json
+    c = conn.cursor()
+    c.execute(SQL_INSERT_CONTACT,
+              (data.get('name'), data.get('email'), data.get('phone'),
+               data.get('company'), data.get('company_id'), data.get('title'), data.get('website'),
+               data.get('additional_info')))
+    contact_id = last_insert_id(c)
+    bump_table_versions(c, 'contacts')
+    return jsonify({'id': contact_id}), 201
 
 @app.route('/api/contacts/<int:contact_id>', methods=['PUT'])
-def update_contact(contact_id):
-    def do_update():
-        data = request.json
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            if USE_POSTGRES:
-                c.execute('''UPDATE contacts
-                            SET name=%s, email=%s, phone=%s, company=%s, company_id=%s, title=%s, website=%s, additional_info=%s
-                            WHERE id=%s''',
-                         (data.get('name'), data.get('email'), data.get('phone'),
-                          data.get('company'), data.get('company_id'), data.get('title'), data.get('website'),
-                          data.get('additional_info'), contact_id))
-            else:
-                c.execute('''UPDATE contacts
-                            SET name=?, email=?, phone=?, company=?, company_id=?, title=?, website=?, additional_info=?
-                            WHERE id=?''',
-                         (data.get('name'), data.get('email'), data.get('phone'),
-                          data.get('company'), data.get('company_id'), data.get('title'), data.get('website'),
-                          data.get('additional_info'), contact_id))
-            conn.commit()
-            return True
-        finally:
-            conn.close()
-
-    try:
-        execute_with_retry(do_update)
-        return jsonify({'success': True})
-    except Exception as e:
-        print(f"Error in update_contact: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@db_endpoint
+def update_contact(conn, contact_id):
+    data = request.json
+    c = conn.cursor()
+    c.execute(SQL_UPDATE_CONTACT,
+              (data.get('name'), data.get('email'), data.get('phone'),
+               data.get('company'), data.get('company_id'), data.get('title'), data.get('website'),
+               data.get('additional_info'), contact_id))
+    bump_table_versions(c, 'contacts')
+    return '', 204
 
 @app.route('/api/contacts/<int:contact_id>', methods=['DELETE'])
-def delete_contact(contact_id):
-    def do_delete():
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            c.execute('DELETE FROM contacts WHERE id=?', (contact_id,))
-            conn.commit()
-            return True
-        finally:
-            conn.close()
-
-    try:
-        execute_with_retry(do_delete)
-        return jsonify({'success': True})
-    except Exception as e:
-        print(f"Error in delete_contact: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@db_endpoint
+def delete_contact(conn, contact_id):
+    c = conn.cursor()
+    if USE_POSTGRES:
+        # Deals and activities referencing the contact are unlinked by ON DELETE SET NULL
+        c.execute('DELETE FROM contacts WHERE id=%s', (contact_id,))
+    else:
+        # SQLite databases created before ON DELETE SET NULL was declared would
+        # fail the foreign key check, so unlink deals and activities explicitly
+        c.execute('UPDATE deals SET contact_id = NULL WHERE contact_id = ?', (contact_id,))
+        c.execute('UPDATE activities SET contact_id = NULL WHERE contact_id = ?', (contact_id,))
+        c.execute('DELETE FROM contacts WHERE id=?', (contact_id,))
+    bump_table_versions(c, 'contacts', 'deals')
+    return '', 204
 
 # ==================== COMPANIES ENDPOINTS ====================
 
-@app.route('/api/companies', methods=['GET'])
-def get_companies():
-    def do_get():
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            # Get companies with their contact count
-            if USE_POSTGRES:
-                c.execute('''
-                    SELECT c.*, COUNT(ct.id) as contact_count
-                    FROM companies c
-                    LEFT JOIN contacts ct ON c.id = ct.company_id
-                    GROUP BY c.id, c.name, c.website, c.industry, c.notes, c.created_at
-                    ORDER BY c.name
-                ''')
-            else:
-                c.execute('''
-                    SELECT c.*, COUNT(ct.id) as contact_count
-                    FROM companies c
-                    LEFT JOIN contacts ct ON c.id = ct.company_id
-                    GROUP BY c.id
-                    ORDER BY c.name
-                ''')
-            companies = c.fetchall()
-            return [dict(company) for company in companies]
-        finally:
-            conn.close()
+SQL_SELECT_COMPANY_CONTACTS = convert_query('SELECT id, name, title, email, phone FROM contacts WHERE company_id = ? ORDER BY name')
+SQL_INSERT_COMPANY = prepared_query('insert_company',
+                                    '''INSERT INTO companies (name, website, industry, notes)
+                                       VALUES (?, ?, ?, ?)''' + RETURNING_ID)
+SQL_UPDATE_COMPANY = prepared_query('update_company',
+                                    '''UPDATE companies
+                                       SET name=?, website=?, industry=?, notes=?
+                                       WHERE id=?''')
 
-    try:
-        companies = execute_with_retry(do_get)
-        return jsonify(companies)
-    except Exception as e:
-        print(f"Error in get_companies: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@app.route('/api/companies', methods=['GET'])
+@db_endpoint
+def get_companies(conn):
+    c = conn.cursor()
+    etag = table_versions_etag(c, 'companies', 'contacts')
+    if request.if_none_match.contains(etag):
+        return etag_response(etag, None)
+    # Get companies with their contact count; each count is an index-only
+    # lookup on idx_contacts_company_id, so no wide GROUP BY is needed
+    c.execute('''
+        SELECT c.id, c.name, c.website, c.industry, c.notes,
+               (SELECT COUNT(*) FROM contacts ct WHERE ct.company_id = c.id) as contact_count
+        FROM companies c
+        ORDER BY c.name
+    ''')
+    return etag_response(etag, fetch_dicts(c))
 
 @app.route('/api/companies/<int:company_id>/contacts', methods=['GET'])
-def get_company_contacts(company_id):
-    def do_get():
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            if USE_POSTGRES:
-                c.execute('SELECT * FROM contacts WHERE company_id = %s ORDER BY name', (company_id,))
-            else:
-                c.execute('SELECT * FROM contacts WHERE company_id = ? ORDER BY name', (company_id,))
-            contacts = c.fetchall()
-            return [dict(contact) for contact in contacts]
-        finally:
-            conn.close()
-
-    try:
-        contacts = execute_with_retry(do_get)
-        return jsonify(contacts)
-    except Exception as e:
-        print(f"Error in get_company_contacts: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@db_endpoint
+def get_company_contacts(conn, company_id):
+    c = conn.cursor()
+    c.execute(SQL_SELECT_COMPANY_CONTACTS, (company_id,))
+    return json_response(fetch_dicts(c))
 
 @app.route('/api/companies', methods=['POST'])
-def add_company():
-    def do_add():
-        data = request.json
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            if USE_POSTGRES:
-                c.execute('''INSERT INTO companies (name, website, industry, notes)
-                            VALUES (%s, %s, %s, %s) RETURNING id''',
-                         (data.get('name'), data.get('website'), data.get('industry'), data.get('notes')))
-                company_id = c.fetchone()['id']
-            else:
-                c.execute('''INSERT INTO companies (name, website, industry, notes)
-                            VALUES (?, ?, ?, ?)''',
-                         (data.get('name'), data.get('website'), data.get('industry'), data.get('notes')))
-                company_id = c.lastrowid
-            conn.commit()
-            return company_id
-        finally:
-            conn.close()
-
-    try:
-        company_id = execute_with_retry(do_add)
-        return jsonify({'id': company_id}), 201
-    except Exception as e:
-        print(f"Error in add_company: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@db_endpoint
+def add_company(conn):
+    data = request.json
+    c = conn.cursor()
+    c.execute(SQL_INSERT_COMPANY,
+              (data.get('name'), data.get('website'), data.get('industry'), data.get('notes')))
+    company_id = last_insert_id(c)
+    bump_table_versions(c, 'companies')
+    return jsonify({'id': company_id}), 201
 
 @app.route('/api/companies/<int:company_id>', methods=['PUT'])
-def update_company(company_id):
-    def do_update():
-        data = request.json
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            if USE_POSTGRES:
-                c.execute('''UPDATE companies
-                            SET name=%s, website=%s, industry=%s, notes=%s
-                            WHERE id=%s''',
-                         (data.get('name'), data.get('website'), data.get('industry'),
-                          data.get('notes'), company_id))
-            else:
-                c.execute('''UPDATE companies
-                            SET name=?, website=?, industry=?, notes=?
-                            WHERE id=?''',
-                         (data.get('name'), data.get('website'), data.get('industry'),
-                          data.get('notes'), company_id))
-            conn.commit()
-            return True
-        finally:
-            conn.close()
-
-    try:
-        execute_with_retry(do_update)
-        return jsonify({'success': True})
-    except Exception as e:
-        print(f"Error in update_company: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@db_endpoint
+def update_company(conn, company_id):
+    data = request.json
+    c = conn.cursor()
+    c.execute(SQL_UPDATE_COMPANY,
+              (data.get('name'), data.get('website'), data.get('industry'),
+               data.get('notes'), company_id))
+    bump_table_versions(c, 'companies')
+    return '', 204
 
 @app.route('/api/companies/<int:company_id>', methods=['DELETE'])
-def delete_company(company_id):
-    def do_delete():
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            # Set company_id to NULL for all contacts before deleting company
-            if USE_POSTGRES:
-                c.execute('UPDATE contacts SET company_id = NULL WHERE company_id = %s', (company_id,))
-                c.execute('DELETE FROM companies WHERE id=%s', (company_id,))
-            else:
-                c.execute('UPDATE contacts SET company_id = NULL WHERE company_id = ?', (company_id,))
-                c.execute('DELETE FROM companies WHERE id=?', (company_id,))
-            conn.commit()
-            return True
-        finally:
-            conn.close()
-
-    try:
-        execute_with_retry(do_delete)
-        return jsonify({'success': True})
-    except Exception as e:
-        print(f"Error in delete_company: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@db_endpoint
+def delete_company(conn, company_id):
+    c = conn.cursor()
+    if USE_POSTGRES:
+        # migrate_db declares contacts.company_id ON DELETE SET NULL, which unlinks contacts
+        c.execute('DELETE FROM companies WHERE id=%s', (company_id,))
+    else:
+        # SQLite can't redeclare a constraint without rebuilding the table, so databases
+        # created before ON DELETE SET NULL was declared still need the explicit UPDATE
+        c.execute('UPDATE contacts SET company_id = NULL WHERE company_id = ?', (company_id,))
+        c.execute('UPDATE documents SET company_id = NULL WHERE company_id = ?', (company_id,))
+        c.execute('DELETE FROM companies WHERE id=?', (company_id,))
+    bump_table_versions(c, 'companies', 'contacts')
+    return '', 204
 
 # ==================== SKU ENDPOINTS ====================
 
+# SKUs only change when populate_skus() runs, so the organized JSON is built once
+# and served from memory. Holds (json_body, etag) once built.
+sku_cache = None
+
 @app.route('/api/skus', methods=['GET'])
 def get_skus():
-    conn = get_db()
-    c = conn.cursor()
-    c.execute('SELECT * FROM skus ORDER BY category, subcategory, name')
-    skus = c.fetchall()
-    conn.close()
-    
-    # Organize SKUs by category and subcategory
-    organized = {}
-    for sku in skus:
-        cat = sku['category']
-        subcat = sku['subcategory']
-        if cat not in organized:
-            organized[cat] = {}
-        if subcat not in organized[cat]:
-            organized[cat][subcat] = []
-        organized[cat][subcat].append(dict(sku))
-    
-    return jsonify(organized)
+    global sku_cache
+    if sku_cache is None:
+        with get_db() as conn:
+            c = conn.cursor()
+            c.execute('SELECT * FROM skus ORDER BY category, subcategory, name')
+            skus = fetch_dicts(c)
+
+        # Organize SKUs by category and subcategory
+        organized = {}
+        for sku in skus:
+            cat = sku['category']
+            subcat = sku['subcategory']
+            if cat not in organized:
+                organized[cat] = {}
+            if subcat not in organized[cat]:
+                organized[cat][subcat] = []
+            organized[cat][subcat].append(sku)
+
+        body = orjson.dumps(organized)
+        sku_cache = (body, hashlib.md5(body).hexdigest())
+
+    body, etag = sku_cache
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = 300
+    return response.make_conditional(request)
 
 # ==================== DEALS/OPPORTUNITIES ENDPOINTS ====================
 
+SQL_INSERT_DEAL = prepared_query('insert_deal',
+                                 '''INSERT INTO deals (name, contact_id, value, probability, stage, status,
+                                                     lead_source, budget, authority, need, timeline, expected_close_date, closed_revenue)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''' + RETURNING_ID)
+SQL_DELETE_DEAL = prepared_query('delete_deal', 'DELETE FROM deals WHERE id=?')
+if USE_POSTGRES:
+    # Update the deal and sync its SKUs in one round-trip. All parts of the
+    # statement see the same snapshot, so the DELETE only removes SKUs that
+    # are no longer wanted and the INSERT skips ones that are already linked.
+    SQL_UPDATE_DEAL = prepared_query('update_deal',
+                                     '''WITH updated AS (
+                                            UPDATE deals
+                                            SET name=?, contact_id=?, value=?, probability=?, stage=?, status=?,
+                                                lead_source=?, budget=?, authority=?, need=?, timeline=?, expected_close_date=?, closed_revenue=?
+                                            WHERE id=?
+                                        ), removed AS (
+                                            DELETE FROM deal_skus WHERE deal_id = ? AND sku_id <> ALL(?::int[])
+                                        )
+                                        INSERT INTO deal_skus (deal_id, sku_id)
+                                        SELECT ?::int, sku_id FROM unnest(?::int[]) AS sku_id
+                                        ON CONFLICT (deal_id, sku_id) DO NOTHING''')
+else:
+    # SKUs are synced separately by sync_deal_skus()
+    SQL_UPDATE_DEAL = '''UPDATE deals
+                         SET name=?, contact_id=?, value=?, probability=?, stage=?, status=?,
+                             lead_source=?, budget=?, authority=?, need=?, timeline=?, expected_close_date=?, closed_revenue=?
+                         WHERE id=?'''
+
+def insert_deal_skus(c, deal_id, sku_ids):
+    """Link SKUs to a deal in a single batch"""
+    rows = [(deal_id, sku_id) for sku_id in sku_ids]
+    if not rows:
+        return
+    if USE_POSTGRES:
+        execute_values(c, 'INSERT INTO deal_skus (deal_id, sku_id) VALUES %s', rows)
+    else:
+        c.executemany('INSERT INTO deal_skus (deal_id, sku_id) VALUES (?, ?)', rows)
+
+def sync_deal_skus(c, deal_id, sku_ids):
+    """Make a deal's SKUs match sku_ids, touching only rows that changed
+    (SQLite; PostgreSQL does this inside update_deal's statement)"""
+    c.execute('SELECT sku_id FROM deal_skus WHERE deal_id = ?', (deal_id,))
+    existing = {row['sku_id'] for row in c.fetchall()}
+    to_delete = existing - set(sku_ids)
+    if to_delete:
+        placeholders = ', '.join('?' * len(to_delete))
+        c.execute(f'DELETE FROM deal_skus WHERE deal_id = ? AND sku_id IN ({placeholders})',
+                  (deal_id, *to_delete))
+    insert_deal_skus(c, deal_id, [sku_id for sku_id in sku_ids if sku_id not in existing])
+
 @app.route('/api/deals', methods=['GET'])
-def get_deals():
-    def do_get():
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            c.execute('''SELECT d.*, c.name as contact_name FROM deals d
-                         LEFT JOIN contacts c ON d.contact_id = c.id
-                         ORDER BY d.created_at DESC''')
-            deals = c.fetchall()
-
-            deals_list = []
-            for deal in deals:
-                deal_dict = dict(deal)
-                # Get SKUs for this deal
-                if USE_POSTGRES:
-                    c.execute('''SELECT s.* FROM skus s
-                                 INNER JOIN deal_skus ds ON s.id = ds.sku_id
-                                 WHERE ds.deal_id = %s''', (deal['id'],))
-                else:
-                    c.execute('''SELECT s.* FROM skus s
-                                 INNER JOIN deal_skus ds ON s.id = ds.sku_id
-                                 WHERE ds.deal_id = ?''', (deal['id'],))
-                skus = c.fetchall()
-                deal_dict['skus'] = [dict(sku) for sku in skus]
-                deals_list.append(deal_dict)
+@db_endpoint
+def get_deals(conn):
+    c = conn.cursor()
+    etag = table_versions_etag(c, 'deals', 'contacts')
+    if request.if_none_match.contains(etag):
+        return etag_response(etag, None)
+    if USE_POSTGRES:
+        # The database nests each deal's SKUs itself, so rows go straight to the response
+        c.execute('''SELECT d.id, d.name, d.contact_id, d.value, d.probability, d.stage, d.status,
+                            d.lead_source, d.budget, d.authority, d.need, d.timeline,
+                            d.expected_close_date, d.closed_revenue, c.name as contact_name,
+                            COALESCE((SELECT json_agg(json_build_object('id', s.id, 'name', s.name,
+                                                                        'category', s.category,
+                                                                        'subcategory', s.subcategory))
+                                      FROM deal_skus ds
+                                      INNER JOIN skus s ON s.id = ds.sku_id
+                                      WHERE ds.deal_id = d.id), '[]'::json) as skus
+                     FROM deals d
+                     LEFT JOIN contacts c ON d.contact_id = c.id
+                     ORDER BY d.created_at DESC''')
+        return etag_response(etag, c.fetchall())
+
+    c.execute('''SELECT d.id, d.name, d.contact_id, d.value, d.probability, d.stage, d.status,
+                        d.lead_source, d.budget, d.authority, d.need, d.timeline,
+                        d.expected_close_date, d.closed_revenue, c.name as contact_name
+                 FROM deals d
+                 LEFT JOIN contacts c ON d.contact_id = c.id
+                 ORDER BY d.created_at DESC''')
+    deals = fetch_dicts(c)
+
+    # Get SKUs for all deals in one query instead of one per deal
+    deal_ids = [deal['id'] for deal in deals]
+    sku_map = defaultdict(list)
+    if deal_ids:
+        placeholders = ','.join(['?'] * len(deal_ids))
+        c.execute(f'''SELECT ds.deal_id, s.id, s.name, s.category, s.subcategory FROM skus s
+                     INNER JOIN deal_skus ds ON s.id = ds.sku_id
+                     WHERE ds.deal_id IN ({placeholders})''', deal_ids)
+        for sku in fetch_dicts(c):
+            sku_map[sku.pop('deal_id')].append(sku)
+
+    for deal in deals:
+        deal['skus'] = sku_map.get(deal['id'], [])
+
+    return etag_response(etag, deals)
 
-            return deals_list
-        finally:
-            conn.close()
+@app.route('/api/deals', methods=['POST'])
+@db_endpoint
+def add_deal(conn):
+    data = request.json
+    print(f"Adding deal with data: {data}")
+    c = conn.cursor()
 
-    try:
-        deals_list = execute_with_retry(do_get)
-        return jsonify(deals_list)
-    except Exception as e:
-        print(f"Error in get_deals: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+    c.execute(SQL_INSERT_DEAL,
+              (data.get('name'), data.get('contact_id'), data.get('value'),
+               data.get('probability'), data.get('stage'), data.get('status'),
+               data.get('lead_source'), data.get('budget'), data.get('authority'),
+               data.get('need'), data.get('timeline'), data.get('expected_close_date'),
+               data.get('closed_revenue', 0)))
+    deal_id = last_insert_id(c)
 
-@app.route('/api/deals', methods=['POST'])
-def add_deal():
-    def do_add():
-        conn = get_db()
-        try:
-            data = request.json
-            print(f"Adding deal with data: {data}")
-            c = conn.cursor()
+    # Add SKUs to the deal
+    insert_deal_skus(c, deal_id, data.get('sku_ids', []))
 
-            if USE_POSTGRES:
-                c.execute('''INSERT INTO deals (name, contact_id, value, probability, stage, status,
-                                                lead_source, budget, authority, need, timeline, expected_close_date, closed_revenue)
-                             VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id''',
-                         (data.get('name'), data.get('contact_id'), data.get('value'),
-                          data.get('probability'), data.get('stage'), data.get('status'),
-                          data.get('lead_source'), data.get('budget'), data.get('authority'),
-                          data.get('need'), data.get('timeline'), data.get('expected_close_date'),
-                          data.get('closed_revenue', 0)))
-                deal_id = c.fetchone()['id']
-            else:
-                c.execute('''INSERT INTO deals (name, contact_id, value, probability, stage, status,
-                                                lead_source, budget, authority, need, timeline, expected_close_date, closed_revenue)
-                             VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                         (data.get('name'), data.get('contact_id'), data.get('value'),
-                          data.get('probability'), data.get('stage'), data.get('status'),
-                          data.get('lead_source'), data.get('budget'), data.get('authority'),
-                          data.get('need'), data.get('timeline'), data.get('expected_close_date'),
-                          data.get('closed_revenue', 0)))
-                deal_id = c.lastrowid
-
-            # Add SKUs to the deal
-            sku_ids = data.get('sku_ids', [])
-            for sku_id in sku_ids:
-                if USE_POSTGRES:
-                    c.execute('INSERT INTO deal_skus (deal_id, sku_id) VALUES (%s, %s)',
-                             (deal_id, sku_id))
-                else:
-                    c.execute('INSERT INTO deal_skus (deal_id, sku_id) VALUES (?, ?)',
-                             (deal_id, sku_id))
-
-            conn.commit()
-            print(f"Deal created successfully with id: {deal_id}")
-            return deal_id
-        finally:
-            conn.close()
-    
-    try:
-        deal_id = execute_with_retry(do_add)
-        return jsonify({'id': deal_id}), 201
-    except Exception as e:
-        print(f"Error in add_deal: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+    bump_table_versions(c, 'deals')
+    print(f"Deal created successfully with id: {deal_id}")
+    return jsonify({'id': deal_id}), 201
 
 @app.route('/api/deals/<int:deal_id>', methods=['PUT'])
-def update_deal(deal_id):
-    def do_update():
-        data = request.json
-        print(f"Updating deal {deal_id} with data: {data}")
-        conn = get_db()
-        try:
-            c = conn.cursor()
+@db_endpoint
+def update_deal(conn, deal_id):
+    data = request.json
+    print(f"Updating deal {deal_id} with data: {data}")
+    c = conn.cursor()
 
-            if USE_POSTGRES:
-                c.execute('''UPDATE deals
-                             SET name=%s, contact_id=%s, value=%s, probability=%s, stage=%s, status=%s,
-                                 lead_source=%s, budget=%s, authority=%s, need=%s, timeline=%s, expected_close_date=%s, closed_revenue=%s
-                             WHERE id=%s''',
-                         (data.get('name'), data.get('contact_id'), data.get('value'),
-                          data.get('probability'), data.get('stage'), data.get('status'),
-                          data.get('lead_source'), data.get('budget'), data.get('authority'),
-                          data.get('need'), data.get('timeline'), data.get('expected_close_date'),
-                          data.get('closed_revenue', 0), deal_id))
-
-                # Update SKUs - delete old ones and add new ones
-                c.execute('DELETE FROM deal_skus WHERE deal_id=%s', (deal_id,))
-                sku_ids = data.get('sku_ids', [])
-                for sku_id in sku_ids:
-                    c.execute('INSERT INTO deal_skus (deal_id, sku_id) VALUES (%s, %s)',
-                             (deal_id, sku_id))
-            else:
-                c.execute('''UPDATE deals
-                             SET name=?, contact_id=?, value=?, probability=?, stage=?, status=?,
-                                 lead_source=?, budget=?, authority=?, need=?, timeline=?, expected_close_date=?, closed_revenue=?
-                             WHERE id=?''',
-                         (data.get('name'), data.get('contact_id'), data.get('value'),
-                          data.get('probability'), data.get('stage'), data.get('status'),
-                          data.get('lead_source'), data.get('budget'), data.get('authority'),
-                          data.get('need'), data.get('timeline'), data.get('expected_close_date'),
-                          data.get('closed_revenue', 0), deal_id))
-
-                # Update SKUs - delete old ones and add new ones
-                c.execute('DELETE FROM deal_skus WHERE deal_id=?', (deal_id,))
-                sku_ids = data.get('sku_ids', [])
-                for sku_id in sku_ids:
-                    c.execute('INSERT INTO deal_skus (deal_id, sku_id) VALUES (?, ?)',
-                             (deal_id, sku_id))
-
-            conn.commit()
-            print(f"Deal {deal_id} updated successfully")
-            return True
-        finally:
-            conn.close()
-    
-    try:
-        execute_with_retry(do_update)
-        return jsonify({'success': True})
-    except Exception as e:
-        print(f"Error in update_deal: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+    sku_ids = [int(sku_id) for sku_id in data.get('sku_ids', [])]
+    params = (data.get('name'), data.get('contact_id'), data.get('value'),
+              data.get('probability'), data.get('stage'), data.get('status'),
+              data.get('lead_source'), data.get('budget'), data.get('authority'),
+              data.get('need'), data.get('timeline'), data.get('expected_close_date'),
+              data.get('closed_revenue', 0), deal_id)
+    if USE_POSTGRES:
+        c.execute(SQL_UPDATE_DEAL, params + (deal_id, sku_ids, deal_id, sku_ids))
+    else:
+        c.execute(SQL_UPDATE_DEAL, params)
+        sync_deal_skus(c, deal_id, sku_ids)
 
-@app.route('/api/deals/<int:deal_id>', methods=['DELETE'])
-def delete_deal(deal_id):
-    def do_delete():
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            if USE_POSTGRES:
-                c.execute('DELETE FROM deals WHERE id=%s', (deal_id,))
-            else:
-                c.execute('DELETE FROM deals WHERE id=?', (deal_id,))
-            conn.commit()
-            return True
-        finally:
-            conn.close()
+    bump_table_versions(c, 'deals')
+    print(f"Deal {deal_id} updated successfully")
+    return jsonify({'success': True})
 
-    try:
-        execute_with_retry(do_delete)
-        return jsonify({'success': True})
-    except Exception as e:
-        print(f"Error in delete_deal: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@app.route('/api/deals/<int:deal_id>', methods=['DELETE'])
+@db_endpoint
+def delete_deal(conn, deal_id):
+    c = conn.cursor()
+    if not USE_POSTGRES:
+        # Same as ON DELETE CASCADE / SET NULL, for SQLite databases created
+        # before those actions were declared
+        c.execute('DELETE FROM activities WHERE deal_id = ?', (deal_id,))
+        c.execute('UPDATE documents SET deal_id = NULL WHERE deal_id = ?', (deal_id,))
+    c.execute(SQL_DELETE_DEAL, (deal_id,))
+    bump_table_versions(c, 'deals')
+    return jsonify({'success': True})
 
 # ==================== ACTIVITIES ENDPOINTS ====================
 
-@app.route('/api/activities', methods=['GET'])
-def get_activities():
-    def do_get():
-        deal_id = request.args.get('deal_id')
-        conn = get_db()
-        try:
-            c = conn.cursor()
+SQL_INSERT_ACTIVITY = prepared_query('insert_activity',
+                                     '''INSERT INTO activities (deal_id, contact_id, type, description, next_steps, due_date)
+                                        VALUES (?, ?, ?, ?, ?, ?)''')
+ACTIVITY_COLUMNS = 'id, deal_id, contact_id, type, description, next_steps, due_date, created_at'
+SQL_SELECT_DEAL_ACTIVITIES = convert_query(f'SELECT {ACTIVITY_COLUMNS} FROM activities WHERE deal_id=? ORDER BY created_at DESC')
 
-            if deal_id:
-                if USE_POSTGRES:
-                    c.execute('SELECT * FROM activities WHERE deal_id=%s ORDER BY created_at DESC', (deal_id,))
-                else:
-                    c.execute('SELECT * FROM activities WHERE deal_id=? ORDER BY created_at DESC', (deal_id,))
-            else:
-                c.execute('SELECT * FROM activities ORDER BY created_at DESC')
+@app.route('/api/activities', methods=['GET'])
+@db_endpoint
+def get_activities(conn):
+    deal_id = request.args.get('deal_id')
+    c = conn.cursor()
 
-            activities = c.fetchall()
-            return [dict(activity) for activity in activities]
-        finally:
-            conn.close()
+    if deal_id:
+        c.execute(SQL_SELECT_DEAL_ACTIVITIES, (deal_id,))
+    else:
+        c.execute(f'SELECT {ACTIVITY_COLUMNS} FROM activities ORDER BY created_at DESC')
 
-    try:
-        activities = execute_with_retry(do_get)
-        return jsonify(activities)
-    except Exception as e:
-        print(f"Error in get_activities: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+    return json_response(fetch_dicts(c))
 
 @app.route('/api/activities', methods=['POST'])
-def add_activity():
-    def do_add():
-        data = request.json
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            if USE_POSTGRES:
-                c.execute('''INSERT INTO activities (deal_id, contact_id, type, description, next_steps, due_date)
-                             VALUES (%s, %s, %s, %s, %s, %s)''',
-                         (data.get('deal_id'), data.get('contact_id'), data.get('type'),
-                          data.get('description'), data.get('next_steps'), data.get('due_date')))
-            else:
-                c.execute('''INSERT INTO activities (deal_id, contact_id, type, description, next_steps, due_date)
-                             VALUES (?, ?, ?, ?, ?, ?)''',
-                         (data.get('deal_id'), data.get('contact_id'), data.get('type'),
-                          data.get('description'), data.get('next_steps'), data.get('due_date')))
-            conn.commit()
-            return True
-        finally:
-            conn.close()
-
-    try:
-        execute_with_retry(do_add)
-        return jsonify({'success': True}), 201
-    except Exception as e:
-        print(f"Error in add_activity: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@db_endpoint
+def add_activity(conn):
+    data = request.json
+    c = conn.cursor()
+    c.execute(SQL_INSERT_ACTIVITY,
+              (data.get('deal_id'), data.get('contact_id'), data.get('type'),
+               data.get('description'), data.get('next_steps'), data.get('due_date')))
+    return jsonify({'success': True}), 201
 
 # ==================== REVENUE/METRICS ENDPOINTS ====================
 
-@app.route('/api/revenue', methods=['GET'])
-def get_revenue():
-    def do_get():
-        conn = get_db()
-        try:
-            c = conn.cursor()
-
-            if USE_POSTGRES:
-                c.execute('SELECT SUM(value) as total FROM deals WHERE status = %s', ('closed',))
-                realized = c.fetchone()
-                c.execute('SELECT SUM(value) as total FROM deals WHERE status = %s', ('open',))
-                pipeline = c.fetchone()
-                c.execute('SELECT value, probability FROM deals WHERE status = %s', ('open',))
-                open_deals = c.fetchall()
-            else:
-                realized = c.execute('SELECT SUM(value) as total FROM deals WHERE status = ?', ('closed',)).fetchone()
-                pipeline = c.execute('SELECT SUM(value) as total FROM deals WHERE status = ?', ('open',)).fetchone()
-                open_deals = c.execute('SELECT value, probability FROM deals WHERE status = ?', ('open',)).fetchall()
-
-            forecasted = sum((deal['value'] * deal['probability'] / 100) for deal in open_deals if deal['value'] and deal['probability'])
+def revenue_data(c):
+    # All three figures in one pass. value is REAL (single precision on
+    # PostgreSQL), so sum it as double precision.
+    c.execute('''SELECT status,
+                        SUM(CAST(value AS DOUBLE PRECISION)) as total,
+                        SUM(CAST(value AS DOUBLE PRECISION) * probability / 100) as weighted
+                 FROM deals
+                 WHERE status IN ('open', 'closed')
+                 GROUP BY status''')
+    totals = {row['status']: row for row in c.fetchall()}
+    pipeline = totals.get('open')
+    realized = totals.get('closed')
+
+    return {
+        'pipeline': (pipeline and pipeline['total']) or 0,
+        'forecasted': (pipeline and pipeline['weighted']) or 0,
+        'realized': (realized and realized['total']) or 0
+    }
 
-            return {
-                'pipeline': pipeline['total'] or 0,
-                'forecasted': forecasted,
-                'realized': realized['total'] or 0
-            }
-        finally:
-            conn.close()
-
-    try:
-        revenue = execute_with_retry(do_get)
-        return jsonify(revenue)
-    except Exception as e:
-        print(f"Error in get_revenue: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@app.route('/api/revenue', methods=['GET'])
+@db_endpoint
+def get_revenue(conn):
+    c = conn.cursor()
+    etag = table_versions_etag(c, 'deals')
+    if request.if_none_match.contains(etag):
+        return etag_response(etag, None)
+    return etag_response(etag, cached_payload(c, 'revenue', etag, revenue_data))
 
 # ==================== PIPELINE ANALYTICS ENDPOINT ====================
 
-@app.route('/api/pipeline/analytics', methods=['GET'])
-def get_pipeline_analytics():
-    def do_get():
-        conn = get_db()
-        try:
-            c = conn.cursor()
-
-            # Get all open deals with details
-            c.execute('''SELECT d.*, c.name as contact_name FROM deals d
-                         LEFT JOIN contacts c ON d.contact_id = c.id
-                         WHERE d.status = 'open'
-                         ORDER BY d.expected_close_date ASC, d.value DESC''')
-            deals = c.fetchall()
-
-            # Organize by stage
-            stages = {}
-            stage_order = ['qualification', 'needs_analysis', 'proposal', 'negotiation']
-
-            for stage in stage_order:
-                stages[stage] = {
-                    'deals': [],
-                    'total_value': 0,
-                    'weighted_value': 0,
-                    'count': 0
-                }
-
-            for deal in deals:
-                deal_dict = dict(deal)
-                stage = deal['stage']
-                if stage in stages:
-                    # Get SKUs for this deal
-                    if USE_POSTGRES:
-                        c.execute('''SELECT s.* FROM skus s
-                                     INNER JOIN deal_skus ds ON s.id = ds.sku_id
-                                     WHERE ds.deal_id = %s''', (deal['id'],))
-                    else:
-                        c.execute('''SELECT s.* FROM skus s
-                                     INNER JOIN deal_skus ds ON s.id = ds.sku_id
-                                     WHERE ds.deal_id = ?''', (deal['id'],))
-                    skus = c.fetchall()
-                    deal_dict['skus'] = [dict(sku) for sku in skus]
-
-                    stages[stage]['deals'].append(deal_dict)
-                    stages[stage]['total_value'] += deal['value'] or 0
-                    stages[stage]['weighted_value'] += (deal['value'] or 0) * (deal['probability'] or 0) / 100
-                    stages[stage]['count'] += 1
-
-            # Calculate totals
-            total_pipeline = sum(s['total_value'] for s in stages.values())
-            total_weighted = sum(s['weighted_value'] for s in stages.values())
-            total_deals = sum(s['count'] for s in stages.values())
-
-            # Group by expected close date (monthly) with SKU category breakdown
-            monthly_forecast = {}
-            for deal in deals:
-                close_date = deal['expected_close_date'] if 'expected_close_date' in deal.keys() else None
-                if close_date:
-                    month_key = close_date[:7]  # YYYY-MM
-                else:
-                    month_key = 'No Date Set'
-
-                if month_key not in monthly_forecast:
-                    monthly_forecast[month_key] = {
-                        'total': 0,
-                        'weighted': 0,
-                        'count': 0,
-                        'categories': {
-                            'Fiber': {'total': 0, 'weighted': 0, 'count': 0},
-                            'Hurd': {'total': 0, 'weighted': 0, 'count': 0},
-                            'Insulation': {'total': 0, 'weighted': 0, 'count': 0},
-                            'Acoustic Panels': {'total': 0, 'weighted': 0, 'count': 0}
-                        }
-                    }
-
-                monthly_forecast[month_key]['total'] += deal['value'] or 0
-                monthly_forecast[month_key]['weighted'] += (deal['value'] or 0) * (deal['probability'] or 0) / 100
-                monthly_forecast[month_key]['count'] += 1
-
-                # Get SKUs for this deal and categorize
-                if USE_POSTGRES:
-                    c.execute('''SELECT s.* FROM skus s
-                                 INNER JOIN deal_skus ds ON s.id = ds.sku_id
-                                 WHERE ds.deal_id = %s''', (deal['id'],))
-                else:
-                    c.execute('''SELECT s.* FROM skus s
-                                 INNER JOIN deal_skus ds ON s.id = ds.sku_id
-                                 WHERE ds.deal_id = ?''', (deal['id'],))
-                deal_skus = c.fetchall()
-
-                # Track which categories this deal has
-                deal_categories = set()
-                for sku in deal_skus:
-                    category = dict(sku)['subcategory']
-                    if category in monthly_forecast[month_key]['categories']:
-                        deal_categories.add(category)
-
-                # Split deal value equally across categories if deal has SKUs
-                if deal_categories:
-                    value_per_category = (deal['value'] or 0) / len(deal_categories)
-                    weighted_per_category = ((deal['value'] or 0) * (deal['probability'] or 0) / 100) / len(deal_categories)
-
-                    for category in deal_categories:
-                        monthly_forecast[month_key]['categories'][category]['total'] += value_per_category
-                        monthly_forecast[month_key]['categories'][category]['weighted'] += weighted_per_category
-                        monthly_forecast[month_key]['categories'][category]['count'] += 1
-
-            return {
-                'stages': stages,
-                'monthly_forecast': monthly_forecast,
-                'totals': {
-                    'pipeline': total_pipeline,
-                    'weighted': total_weighted,
-                    'deal_count': total_deals
-                }
+# Pipeline stages and forecast categories reported by the analytics endpoint, in display order
+STAGE_ORDER = ('qualification', 'needs_analysis', 'proposal', 'negotiation')
+FORECAST_CATEGORIES = ('Fiber', 'Hurd', 'Insulation', 'Acoustic Panels')
+
+def pipeline_analytics_data(c):
+    # Get SKUs for all open deals in one query instead of one per deal
+    c.execute('''SELECT ds.deal_id, s.id, s.name, s.category, s.subcategory FROM skus s
+                 INNER JOIN deal_skus ds ON s.id = ds.sku_id
+                 INNER JOIN deals d ON d.id = ds.deal_id
+                 WHERE d.status = 'open'
+                 ORDER BY ds.id''')
+    sku_map = defaultdict(list)
+    for sku in fetch_dicts(c):
+        sku_map[sku.pop('deal_id')].append(sku)
+
+    # Organize by stage
+    stages = {stage: {'deals': [], 'total_value': 0, 'weighted_value': 0, 'count': 0}
+              for stage in STAGE_ORDER}
+
+    # Stage totals are aggregated by the database
+    c.execute('''SELECT stage, COUNT(*) as count,
+                        SUM(CAST(value AS DOUBLE PRECISION)) as total_value,
+                        SUM(CAST(value AS DOUBLE PRECISION) * probability / 100) as weighted_value
+                 FROM deals
+                 WHERE status = 'open'
+                 GROUP BY stage''')
+    for row in c.fetchall():
+        stage = stages.get(row['stage'])
+        if stage is not None:
+            stage['total_value'] = row['total_value'] or 0
+            stage['weighted_value'] = row['weighted_value'] or 0
+            stage['count'] = row['count']
+
+    # Calculate totals
+    total_pipeline = sum(s['total_value'] for s in stages.values())
+    total_weighted = sum(s['weighted_value'] for s in stages.values())
+    total_deals = sum(s['count'] for s in stages.values())
+
+    # All open deals with details, walked once for both the stage lists and the
+    # monthly forecast. Every deal ends up in the response, so they are fetched
+    # in one go rather than in server-side cursor batches.
+    c.execute('''SELECT d.id, d.name, d.contact_id, d.value, d.probability, d.stage,
+                        d.expected_close_date, c.name as contact_name,
+                        COALESCE(NULLIF(substr(d.expected_close_date, 1, 7), ''), 'No Date Set') as month_key
+                 FROM deals d
+                 LEFT JOIN contacts c ON d.contact_id = c.id
+                 WHERE d.status = 'open'
+                 ORDER BY d.expected_close_date ASC, d.value DESC''')
+
+    monthly_forecast = {}
+    for deal in fetch_dicts(c):
+        deal_skus = sku_map.get(deal['id'], [])
+        stage = stages.get(deal['stage'])
+        if stage is not None:
+            deal['skus'] = deal_skus
+            stage['deals'].append(deal)
+
+        value = deal['value'] or 0
+        weighted = value * (deal['probability'] or 0) / 100
+
+        # Group by expected close month (YYYY-MM, cut by the query) with SKU category breakdown
+        month_key = deal.pop('month_key')
+        month = monthly_forecast.get(month_key)
+        if month is None:
+            month = monthly_forecast[month_key] = {
+                'total': 0,
+                'weighted': 0,
+                'count': 0,
+                'categories': {category: {'total': 0, 'weighted': 0, 'count': 0}
+                               for category in FORECAST_CATEGORIES}
             }
-        finally:
-            conn.close()
+        categories = month['categories']
+
+        month['total'] += value
+        month['weighted'] += weighted
+        month['count'] += 1
+
+        # Track which categories this deal has
+        deal_categories = {sku['subcategory'] for sku in deal_skus if sku['subcategory'] in categories}
+
+        # Split deal value equally across categories if deal has SKUs
+        if deal_categories:
+            value_per_category = value / len(deal_categories)
+            weighted_per_category = weighted / len(deal_categories)
+
+            for category in deal_categories:
+                bucket = categories[category]
+                bucket['total'] += value_per_category
+                bucket['weighted'] += weighted_per_category
+                bucket['count'] += 1
+
+    return {
+        'stages': stages,
+        'monthly_forecast': monthly_forecast,
+        'totals': {
+            'pipeline': total_pipeline,
+            'weighted': total_weighted,
+            'deal_count': total_deals
+        }
+    }
 
-    try:
-        analytics = execute_with_retry(do_get)
-        return jsonify(analytics)
-    except Exception as e:
-        print(f"Error in get_pipeline_analytics: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@app.route('/api/pipeline/analytics', methods=['GET'])
+@db_endpoint
+def get_pipeline_analytics(conn):
+    c = conn.cursor()
+    etag = table_versions_etag(c, 'deals', 'contacts')
+    if request.if_none_match.contains(etag):
+        return etag_response(etag, None)
+    return etag_response(etag, cached_payload(c, 'pipeline_analytics', etag, pipeline_analytics_data))
 
 # ==================== SETTINGS & GOAL ENDPOINTS ====================
 
-@app.route('/api/settings/<key>', methods=['GET'])
-def get_setting(key):
-    def do_get():
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            if USE_POSTGRES:
-                c.execute('SELECT value FROM settings WHERE key = %s', (key,))
-            else:
-                c.execute('SELECT value FROM settings WHERE key = ?', (key,))
-            result = c.fetchone()
-            return result['value'] if result else None
-        finally:
-            conn.close()
+SQL_UPSERT_SETTING = prepared_query('upsert_setting',
+                                    '''INSERT INTO settings (key, value, updated_at)
+                                       VALUES (?, ?, CURRENT_TIMESTAMP)
+                                       ON CONFLICT (key) DO UPDATE SET value = excluded.value, updated_at = CURRENT_TIMESTAMP''')
+SQL_SELECT_SETTING = convert_query('SELECT value FROM settings WHERE key = ?')
 
-    try:
-        value = execute_with_retry(do_get)
-        if value is None:
-            return jsonify({'error': 'Setting not found'}), 404
-        return jsonify({'key': key, 'value': value})
-    except Exception as e:
-        print(f"Error in get_setting: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@app.route('/api/settings/<key>', methods=['GET'])
+@db_endpoint
+def get_setting(conn, key):
+    c = conn.cursor()
+    c.execute(SQL_SELECT_SETTING, (key,))
+    result = c.fetchone()
+    if result is None:
+        return jsonify({'error': 'Setting not found'}), 404
+    return jsonify({'key': key, 'value': result['value']})
 
 @app.route('/api/settings/<key>', methods=['PUT'])
-def update_setting(key):
-    def do_update():
-        data = request.json
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            if USE_POSTGRES:
-                c.execute('''
-                    INSERT INTO settings (key, value, updated_at)
-                    VALUES (%s, %s, NOW())
-                    ON CONFLICT (key) DO UPDATE SET value = %s, updated_at = NOW()
-                ''', (key, data['value'], data['value']))
-            else:
-                c.execute('''
-                    INSERT OR REPLACE INTO settings (key, value, updated_at)
-                    VALUES (?, ?, CURRENT_TIMESTAMP)
-                ''', (key, data['value']))
-            conn.commit()
-            return True
-        finally:
-            conn.close()
-
-    try:
-        execute_with_retry(do_update)
-        return jsonify({'success': True})
-    except Exception as e:
-        print(f"Error in update_setting: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@db_endpoint
+def update_setting(conn, key):
+    data = request.json
+    c = conn.cursor()
+    c.execute(SQL_UPSERT_SETTING, (key, data['value']))
+    bump_table_versions(c, 'settings')
+    return jsonify({'success': True})
+
+def goal_progress_data(c):
+    # Annual goal from settings and closed revenue from all deals in one round-trip
+    c.execute(convert_query('''SELECT (SELECT value FROM settings WHERE key = ?) as annual_goal,
+                                       COALESCE(SUM(closed_revenue), 0) as total
+                                FROM deals'''), ('annual_goal',))
+    result = c.fetchone()
+    annual_goal = float(result['annual_goal']) if result['annual_goal'] is not None else 1000000
+    closed_revenue = float(result['total'])
+
+    # Calculate percentage
+    percentage = (closed_revenue / annual_goal * 100) if annual_goal > 0 else 0
+
+    return {
+        'annual_goal': annual_goal,
+        'closed_revenue': closed_revenue,
+        'percentage': percentage
+    }
 
 @app.route('/api/goal/progress', methods=['GET'])
-def get_goal_progress():
-    def do_get():
-        conn = get_db()
-        try:
-            c = conn.cursor()
-
-            # Get annual goal from settings
-            if USE_POSTGRES:
-                c.execute('SELECT value FROM settings WHERE key = %s', ('annual_goal',))
-            else:
-                c.execute('SELECT value FROM settings WHERE key = ?', ('annual_goal',))
-            goal_result = c.fetchone()
-            annual_goal = float(goal_result['value']) if goal_result else 1000000
-
-            # Sum closed revenue from all deals
-            if USE_POSTGRES:
-                c.execute('SELECT COALESCE(SUM(closed_revenue), 0) as total FROM deals')
-            else:
-                c.execute('SELECT COALESCE(SUM(closed_revenue), 0) as total FROM deals')
-            revenue_result = c.fetchone()
-            closed_revenue = float(revenue_result['total']) if revenue_result else 0
-
-            # Calculate percentage
-            percentage = (closed_revenue / annual_goal * 100) if annual_goal > 0 else 0
-
-            return {
-                'annual_goal': annual_goal,
-                'closed_revenue': closed_revenue,
-                'percentage': percentage
-            }
-        finally:
-            conn.close()
-
-    try:
-        progress = execute_with_retry(do_get)
-        return jsonify(progress)
-    except Exception as e:
-        print(f"Error in get_goal_progress: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@db_endpoint
+def get_goal_progress(conn):
+    c = conn.cursor()
+    etag = table_versions_etag(c, 'deals', 'settings')
+    if request.if_none_match.contains(etag):
+        return etag_response(etag, None)
+    return etag_response(etag, cached_payload(c, 'goal_progress', etag, goal_progress_data))
 
 # ==================== TASKS ENDPOINTS ====================
 
-@app.route('/api/tasks', methods=['GET'])
-def get_tasks():
-    def do_get():
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            # Get all tasks, ordered by due date and priority
-            c.execute('''
-                SELECT * FROM tasks
-                ORDER BY completed ASC, due_date ASC,
-                CASE priority
-                    WHEN 'High' THEN 1
-                    WHEN 'Medium' THEN 2
-                    WHEN 'Low' THEN 3
-                    ELSE 4
-                END
-            ''')
-            tasks = c.fetchall()
-            return [dict(task) for task in tasks]
-        finally:
-            conn.close()
+SQL_INSERT_TASK = prepared_query('insert_task',
+                                 '''INSERT INTO tasks (name, detail, due_date, completed, priority, category, assignee, recurring)
+                                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)''' + RETURNING_ID)
+SQL_UPDATE_TASK = prepared_query('update_task',
+                                 '''UPDATE tasks
+                                    SET name=?, detail=?, due_date=?, completed=?, priority=?, category=?, assignee=?, recurring=?
+                                    WHERE id=?''')
+SQL_TOGGLE_TASK = prepared_query('toggle_task',
+                                 'UPDATE tasks SET completed = NOT COALESCE(completed, FALSE) WHERE id = ?'
+                                 + (' RETURNING completed' if SUPPORTS_RETURNING else ''))
+SQL_SELECT_TASK_COMPLETED = convert_query('SELECT completed FROM tasks WHERE id = ?')
+SQL_DELETE_TASK = convert_query('DELETE FROM tasks WHERE id=?')
+# Sort rank of task priorities; anything else sorts last
+PRIORITY_RANK = {'High': 0, 'Medium': 1, 'Low': 2}
+SQL_SELECT_WEEK_NEXT_STEPS = convert_query('''
+    SELECT a.id, a.deal_id, a.contact_id, a.type, a.next_steps, a.due_date,
+           d.name as deal_name, c.name as contact_name, 'next_step' as item_type
+    FROM activities a
+    LEFT JOIN deals d ON a.deal_id = d.id
+    LEFT JOIN contacts c ON a.contact_id = c.id
+    WHERE a.due_date >= ? AND a.due_date <= ?
+    ORDER BY a.due_date ASC, a.created_at DESC
+''')
+SQL_SELECT_WEEK_TASKS = convert_query('''
+    SELECT id, name, due_date, completed, priority, category, assignee, 'task' as item_type
+    FROM tasks
+    WHERE completed = FALSE AND due_date >= ? AND due_date <= ?
+    ORDER BY due_date ASC,
+    CASE priority
+        WHEN 'High' THEN 1
+        WHEN 'Medium' THEN 2
+        WHEN 'Low' THEN 3
+        ELSE 4
+    END
+''')
 
-    try:
-        tasks = execute_with_retry(do_get)
-        return jsonify(tasks)
-    except Exception as e:
-        print(f"Error in get_tasks: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@app.route('/api/tasks', methods=['GET'])
+@db_endpoint
+def get_tasks(conn):
+    c = conn.cursor()
+    # Get all tasks, ordered by due date and priority
+    c.execute('''
+        SELECT id, name, detail, due_date, completed, priority, category, assignee, recurring, created_at
+        FROM tasks
+        ORDER BY completed ASC, due_date ASC,
+        CASE priority
+            WHEN 'High' THEN 1
+            WHEN 'Medium' THEN 2
+            WHEN 'Low' THEN 3
+            ELSE 4
+        END
+    ''')
+    return json_response(fetch_dicts(c))
 
 @app.route('/api/tasks', methods=['POST'])
-def add_task():
-    def do_add():
-        data = request.json
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            if USE_POSTGRES:
-                c.execute('''INSERT INTO tasks (name, detail, due_date, completed, priority, category, assignee, recurring)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s) RETURNING id''',
-                         (data.get('name'), data.get('detail'), data.get('due_date'),
-                          data.get('completed', False), data.get('priority'), data.get('category'),
-                          data.get('assignee'), data.get('recurring')))
-                task_id = c.fetchone()['id']
-            else:
-                c.execute('''INSERT INTO tasks (name, detail, due_date, completed, priority, category, assignee, recurring)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                         (data.get('name'), data.get('detail'), data.get('due_date'),
-                          data.get('completed', False), data.get('priority'), data.get('category'),
-                          data.get('assignee'), data.get('recurring')))
-                task_id = c.lastrowid
-            conn.commit()
-            return task_id
-        finally:
-            conn.close()
-
-    try:
-        task_id = execute_with_retry(do_add)
-        return jsonify({'id': task_id}), 201
-    except Exception as e:
-        print(f"Error in add_task: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@db_endpoint
+def add_task(conn):
+    data = request.json
+    c = conn.cursor()
+    c.execute(SQL_INSERT_TASK,
+              (data.get('name'), data.get('detail'), data.get('due_date'),
+               data.get('completed', False), data.get('priority'), data.get('category'),
+               data.get('assignee'), data.get('recurring')))
+    task_id = last_insert_id(c)
+    return jsonify({'id': task_id}), 201
 
 @app.route('/api/tasks/<int:task_id>', methods=['PUT'])
-def update_task(task_id):
-    def do_update():
-        data = request.json
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            if USE_POSTGRES:
-                c.execute('''UPDATE tasks
-                            SET name=%s, detail=%s, due_date=%s, completed=%s, priority=%s, category=%s, assignee=%s, recurring=%s
-                            WHERE id=%s''',
-                         (data.get('name'), data.get('detail'), data.get('due_date'),
-                          data.get('completed'), data.get('priority'), data.get('category'),
-                          data.get('assignee'), data.get('recurring'), task_id))
-            else:
-                c.execute('''UPDATE tasks
-                            SET name=?, detail=?, due_date=?, completed=?, priority=?, category=?, assignee=?, recurring=?
-                            WHERE id=?''',
-                         (data.get('name'), data.get('detail'), data.get('due_date'),
-                          data.get('completed'), data.get('priority'), data.get('category'),
-                          data.get('assignee'), data.get('recurring'), task_id))
-            conn.commit()
-            return True
-        finally:
-            conn.close()
-
-    try:
-        execute_with_retry(do_update)
-        return jsonify({'success': True})
-    except Exception as e:
-        print(f"Error in update_task: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@db_endpoint
+def update_task(conn, task_id):
+    data = request.json
+    c = conn.cursor()
+    c.execute(SQL_UPDATE_TASK,
+              (data.get('name'), data.get('detail'), data.get('due_date'),
+               data.get('completed'), data.get('priority'), data.get('category'),
+               data.get('assignee'), data.get('recurring'), task_id))
+    return jsonify({'success': True})
 
 @app.route('/api/tasks/<int:task_id>/complete', methods=['PATCH'])
-def toggle_task_complete(task_id):
-    def do_toggle():
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            # Get current completed status
-            if USE_POSTGRES:
-                c.execute('SELECT completed FROM tasks WHERE id = %s', (task_id,))
-            else:
-                c.execute('SELECT completed FROM tasks WHERE id = ?', (task_id,))
-            result = c.fetchone()
-            if not result:
-                return None
+@db_endpoint
+def toggle_task_complete(conn, task_id):
+    c = conn.cursor()
+    # Flip the flag and read the new value in one statement
+    c.execute(SQL_TOGGLE_TASK, (task_id,))
+    if not SUPPORTS_RETURNING:
+        # Older SQLite: read it back in the same transaction instead
+        c.execute(SQL_SELECT_TASK_COMPLETED, (task_id,))
+    result = c.fetchone()
+    if not result:
+        return jsonify({'error': 'Task not found'}), 404
+    return jsonify({'success': True, 'completed': bool(result['completed'])})
 
-            new_status = not result['completed']
+@app.route('/api/tasks/<int:task_id>', methods=['DELETE'])
+@db_endpoint
+def delete_task(conn, task_id):
+    c = conn.cursor()
+    c.execute(SQL_DELETE_TASK, (task_id,))
+    return jsonify({'success': True})
 
-            # Update completed status
-            if USE_POSTGRES:
-                c.execute('UPDATE tasks SET completed = %s WHERE id = %s', (new_status, task_id))
-            else:
-                c.execute('UPDATE tasks SET completed = ? WHERE id = ?', (new_status, task_id))
-            conn.commit()
-            return new_status
-        finally:
-            conn.close()
+@app.route('/api/tasks/this-week', methods=['GET'])
+@db_endpoint
+def get_tasks_this_week(conn):
+    c = conn.cursor()
 
-    try:
-        new_status = execute_with_retry(do_toggle)
-        if new_status is None:
-            return jsonify({'error': 'Task not found'}), 404
-        return jsonify({'success': True, 'completed': new_status})
-    except Exception as e:
-        print(f"Error in toggle_task_complete: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+    # Get current week boundaries (Monday to Sunday)
+    today = date.today()
+    # Find Monday of current week
+    monday = today - timedelta(days=today.weekday())
+    # Find Sunday of current week
+    sunday = monday + timedelta(days=6)
+    # Bind real dates on PostgreSQL so the range matches the DATE index directly;
+    # SQLite stores due_date as ISO text, which sorts the same way
+    if not USE_POSTGRES:
+        monday, sunday = monday.isoformat(), sunday.isoformat()
 
-@app.route('/api/tasks/<int:task_id>', methods=['DELETE'])
-def delete_task(task_id):
-    def do_delete():
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            if USE_POSTGRES:
-                c.execute('DELETE FROM tasks WHERE id=%s', (task_id,))
-            else:
-                c.execute('DELETE FROM tasks WHERE id=?', (task_id,))
-            conn.commit()
-            return True
-        finally:
-            conn.close()
+    # Query next steps (activities with due dates in current week)
+    c.execute(SQL_SELECT_WEEK_NEXT_STEPS, (monday, sunday))
+    next_steps = fetch_dicts(c)
 
-    try:
-        execute_with_retry(do_delete)
-        return jsonify({'success': True})
-    except Exception as e:
-        print(f"Error in delete_task: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+    # Query standalone tasks with due dates in current week (exclude completed)
+    c.execute(SQL_SELECT_WEEK_TASKS, (monday, sunday))
+    tasks = fetch_dicts(c)
 
-@app.route('/api/tasks/this-week', methods=['GET'])
-def get_tasks_this_week():
-    def do_get():
-        conn = get_db()
-        try:
-            c = conn.cursor()
+    # Combine both lists and sort by due_date. Both queries filter on due_date, so
+    # it is never NULL, and each list arrives already sorted for timsort to merge.
+    combined = next_steps + tasks
+    combined.sort(key=lambda x: (x['due_date'], PRIORITY_RANK.get(x.get('priority'), 3)))
 
-            # Get current week boundaries (Monday to Sunday)
-            from datetime import datetime, timedelta
-            today = datetime.now().date()
-            # Find Monday of current week
-            monday = today - timedelta(days=today.weekday())
-            # Find Sunday of current week
-            sunday = monday + timedelta(days=6)
+    return json_response(combined)
 
-            # Query next steps (activities with due dates in current week)
-            if USE_POSTGRES:
-                c.execute('''
-                    SELECT a.*, d.name as deal_name, c.name as contact_name, 'next_step' as item_type
-                    FROM activities a
-                    LEFT JOIN deals d ON a.deal_id = d.id
-                    LEFT JOIN contacts c ON a.contact_id = c.id
-                    WHERE a.due_date >= %s AND a.due_date <= %s
-                    ORDER BY a.due_date ASC, a.created_at DESC
-                ''', (str(monday), str(sunday)))
-            else:
-                c.execute('''
-                    SELECT a.*, d.name as deal_name, c.name as contact_name, 'next_step' as item_type
-                    FROM activities a
-                    LEFT JOIN deals d ON a.deal_id = d.id
-                    LEFT JOIN contacts c ON a.contact_id = c.id
-                    WHERE a.due_date >= ? AND a.due_date <= ?
-                    ORDER BY a.due_date ASC, a.created_at DESC
-                ''', (str(monday), str(sunday)))
-
-            next_steps = [dict(row) for row in c.fetchall()]
-
-            # Query standalone tasks with due dates in current week (exclude completed)
-            if USE_POSTGRES:
-                c.execute('''
-                    SELECT *, 'task' as item_type
-                    FROM tasks
-                    WHERE due_date >= %s AND due_date <= %s AND completed = FALSE
-                    ORDER BY due_date ASC,
-                    CASE priority
-                        WHEN 'High' THEN 1
-                        WHEN 'Medium' THEN 2
-                        WHEN 'Low' THEN 3
-                        ELSE 4
-                    END
-                ''', (str(monday), str(sunday)))
-            else:
-                c.execute('''
-                    SELECT *, 'task' as item_type
-                    FROM tasks
-                    WHERE due_date >= ? AND due_date <= ? AND completed = 0
-                    ORDER BY due_date ASC,
-                    CASE priority
-                        WHEN 'High' THEN 1
-                        WHEN 'Medium' THEN 2
-                        WHEN 'Low' THEN 3
-                        ELSE 4
-                    END
-                ''', (str(monday), str(sunday)))
-
-            tasks = [dict(row) for row in c.fetchall()]
-
-            # Combine both lists and sort by due_date
-            combined = next_steps + tasks
-            combined.sort(key=lambda x: (x.get('due_date') or '9999-12-31',
-                                        0 if x.get('priority') == 'High' else
-                                        1 if x.get('priority') == 'Medium' else
-                                        2 if x.get('priority') == 'Low' else 3))
-
-            return combined
-        finally:
-            conn.close()
+# ==================== DOCUMENTS ENDPOINTS ====================
 
-    try:
-        items = execute_with_retry(do_get)
-        return jsonify(items)
-    except Exception as e:
-        print(f"Error in get_tasks_this_week: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+UPLOAD_COPY_BUFFER = 1024 * 1024  # bytes
 
-# ==================== DOCUMENTS ENDPOINTS ====================
+# When a front-end proxy can read uploads/ itself, downloads only send headers and
+# the proxy streams the file. X_ACCEL_REDIRECT_PREFIX is the internal nginx location
+# aliased to uploads/ (e.g. /_protected/); USE_X_SENDFILE=1 emits Apache's X-Sendfile.
+X_ACCEL_REDIRECT_PREFIX = os.environ.get('X_ACCEL_REDIRECT_PREFIX')
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
 
-@app.route('/api/documents', methods=['GET'])
-def get_documents():
-    def do_get():
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            # Get all documents with associated entity names
-            c.execute('''
-                SELECT d.*,
-                       co.name as company_name,
-                       de.name as deal_name
-                FROM documents d
-                LEFT JOIN companies co ON d.company_id = co.id
-                LEFT JOIN deals de ON d.deal_id = de.id
-                ORDER BY d.created_at DESC
-            ''')
-            documents = c.fetchall()
-            return [dict(doc) for doc in documents]
-        finally:
-            conn.close()
+def spooled_file_descriptor(stream):
+    """File descriptor behind an upload stream, or None while it is only in memory.
 
+    Werkzeug keeps small uploads in a SpooledTemporaryFile's memory buffer, and
+    calling fileno() on one that hasn't rolled over would write it to disk first.
+    _rolled is private to SpooledTemporaryFile; if it ever goes away, large
+    uploads just fall back to shutil.copyfileobj like small ones.
+    """
+    if not getattr(stream, '_rolled', False):
+        return None
     try:
-        documents = execute_with_retry(do_get)
-        return jsonify(documents)
-    except Exception as e:
-        print(f"Error in get_documents: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+        return stream.fileno()
+    except (AttributeError, OSError):
+        return None
+
+def save_upload(file, file_path):
+    """Write an uploaded file to file_path and return its size in bytes"""
+    src = file.stream
+    with open(file_path, 'wb') as dst:
+        src_fd = spooled_file_descriptor(src) if sys.platform == 'linux' else None
+        if src_fd is not None:
+            # Werkzeug spools large uploads to a temporary file; let the kernel
+            # copy it instead of reading it through Python buffers
+            start = offset = src.tell()
+            while True:
+                sent = os.sendfile(dst.fileno(), src_fd, offset, UPLOAD_COPY_BUFFER)
+                if not sent:
+                    return offset - start
+                offset += sent
+        shutil.copyfileobj(src, dst, UPLOAD_COPY_BUFFER)
+        return dst.tell()
+
+@app.route('/api/documents', methods=['GET'])
+@db_endpoint
+def get_documents(conn):
+    c = conn.cursor()
+    # Get all documents with associated entity names
+    c.execute('''
+        SELECT d.id, d.name, d.description, d.file_path, d.external_link, d.file_size, d.file_type,
+               d.document_category, d.version, d.expiration_date, d.tags, d.company_id, d.deal_id,
+               d.uploaded_by, d.created_at,
+               co.name as company_name,
+               de.name as deal_name
+        FROM documents d
+        LEFT JOIN companies co ON d.company_id = co.id
+        LEFT JOIN deals de ON d.deal_id = de.id
+        ORDER BY d.created_at DESC
+    ''')
+    return json_response(fetch_dicts(c))
+
+def store_upload(file):
+    """Save an uploaded document under uploads/ and return (file_path, file_size, file_type)"""
+    filename = secure_filename(file.filename)
+
+    # Create uploads directory if it doesn't exist
+    upload_dir = 'uploads'
+    if not os.path.exists(upload_dir):
+        os.makedirs(upload_dir)
+
+    # Save file with timestamp to avoid conflicts
+    timestamp = int(time.time())
+    file_path = os.path.join(upload_dir, f"{timestamp}_{filename}")
+    file_size = save_upload(file, file_path)
+    file_type = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
+    return file_path, file_size, file_type
 
 @app.route('/api/documents', methods=['POST'])
 def add_document():
-    def do_add():
-        from werkzeug.utils import secure_filename
-        import os
-
-        # Check if this is a file upload or external link
-        if 'file' in request.files and request.files['file'].filename:
-            # Handle file upload
-            file = request.files['file']
-            filename = secure_filename(file.filename)
-
-            # Create uploads directory if it doesn't exist
-            upload_dir = 'uploads'
-            if not os.path.exists(upload_dir):
-                os.makedirs(upload_dir)
-
-            # Save file with timestamp to avoid conflicts
-            timestamp = int(time.time())
-            file_path = os.path.join(upload_dir, f"{timestamp}_{filename}")
-            file.save(file_path)
-
-            file_size = os.path.getsize(file_path)
-            file_type = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
-
-            # Get other form data
-            data = request.form
-            external_link = None
-        else:
-            # Handle external link
-            data = request.json if request.is_json else request.form
-            file_path = None
-            external_link = data.get('external_link')
-            file_size = None
-            file_type = None
-
-        conn = get_db()
+    # Write the file before db_endpoint opens the write transaction, so a large
+    # upload doesn't hold SQLite's write lock while it hits the disk, and a
+    # retried insert doesn't save the file twice
+    upload = None
+    if 'file' in request.files and request.files['file'].filename:
         try:
-            c = conn.cursor()
-            if USE_POSTGRES:
-                c.execute('''INSERT INTO documents
-                            (name, description, file_path, external_link, file_size, file_type,
-                             document_category, version, expiration_date, tags, company_id, deal_id, uploaded_by)
-                            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id''',
-                         (data.get('name'), data.get('description'), file_path, external_link,
-                          file_size, file_type, data.get('document_category'), data.get('version'),
-                          data.get('expiration_date'), data.get('tags'),
-                          data.get('company_id') or None, data.get('deal_id') or None,
-                          data.get('uploaded_by')))
-                doc_id = c.fetchone()['id']
-            else:
-                c.execute('''INSERT INTO documents
-                            (name, description, file_path, external_link, file_size, file_type,
-                             document_category, version, expiration_date, tags, company_id, deal_id, uploaded_by)
-                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                         (data.get('name'), data.get('description'), file_path, external_link,
-                          file_size, file_type, data.get('document_category'), data.get('version'),
-                          data.get('expiration_date'), data.get('tags'),
-                          data.get('company_id') or None, data.get('deal_id') or None,
-                          data.get('uploaded_by')))
-                doc_id = c.lastrowid
-            conn.commit()
-            return doc_id
-        finally:
-            conn.close()
+            upload = store_upload(request.files['file'])
+        except OSError as e:
+            print(f"Error in add_document: {e}")
+            traceback.print_exc()
+            return jsonify({'error': str(e)}), 500
+    response = app.make_response(insert_document(upload))
+    if upload and response.status_code >= 300:
+        # The row was never created, so don't keep its file around
+        remove_upload(upload[0])
+    return response
+
+# The INSERT and UPDATE below start with the same columns, filled by document_fields()
+DOCUMENT_INSERT_COLUMNS = '''(name, description, document_category, version, expiration_date, tags, company_id, deal_id,
+                              file_path, external_link, file_size, file_type, uploaded_by)'''
+SQL_INSERT_DOCUMENT = prepared_query('insert_document',
+                                     f'''INSERT INTO documents {DOCUMENT_INSERT_COLUMNS}
+                                         VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''' + RETURNING_ID)
+SQL_UPDATE_DOCUMENT = prepared_query('update_document',
+                                     '''UPDATE documents
+                                        SET name=?, description=?, document_category=?, version=?,
+                                            expiration_date=?, tags=?, company_id=?, deal_id=?, external_link=?
+                                        WHERE id=?''')
+SQL_SELECT_DOCUMENT_FILE = prepared_query('select_document_file',
+                                          'SELECT file_path, name FROM documents WHERE id = ?')
+SQL_DELETE_DOCUMENT = prepared_query('delete_document', 'DELETE FROM documents WHERE id=?')
+
+# (file_path, name) of recently downloaded documents, least recently used first.
+# Only this worker's edits evict entries, so the TTL bounds how long another
+# worker can keep serving a renamed or deleted document's old metadata.
+DOCUMENT_FILE_CACHE_SIZE = 4096
+DOCUMENT_FILE_CACHE_TTL = 60  # seconds
+document_file_cache = OrderedDict()  # doc_id -> (expires_at, file_path, name)
+document_file_cache_lock = threading.Lock()
+
+def cached_document_file(doc_id):
+    """(file_path, name) of a document from the download cache, or None"""
+    with document_file_cache_lock:
+        entry = document_file_cache.get(doc_id)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del document_file_cache[doc_id]
+            return None
+        document_file_cache.move_to_end(doc_id)
+        return entry[1:]
+
+def cache_document_file(doc_id, file_path, name):
+    with document_file_cache_lock:
+        document_file_cache[doc_id] = (time.monotonic() + DOCUMENT_FILE_CACHE_TTL, file_path, name)
+        document_file_cache.move_to_end(doc_id)
+        if len(document_file_cache) > DOCUMENT_FILE_CACHE_SIZE:
+            document_file_cache.popitem(last=False)
+
+def forget_document_file(doc_id):
+    with document_file_cache_lock:
+        document_file_cache.pop(doc_id, None)
+
+def document_fields(data):
+    """Values of the columns document inserts and updates share, from form or JSON data"""
+    # Forms send an empty string when no company or deal is picked
+    return (data.get('name'), data.get('description'), data.get('document_category'),
+            data.get('version'), data.get('expiration_date'), data.get('tags'),
+            data.get('company_id') or None, data.get('deal_id') or None)
+
+def document_row(data, upload=None):
+    """INSERT parameters for a document described by form or JSON data"""
+    if upload:
+        file_path, file_size, file_type = upload
+        external_link = None
+    else:
+        # External link
+        file_path = file_size = file_type = None
+        external_link = data.get('external_link')
+    return document_fields(data) + (file_path, external_link, file_size, file_type, data.get('uploaded_by'))
 
-    try:
-        doc_id = execute_with_retry(do_add)
-        return jsonify({'id': doc_id}), 201
-    except Exception as e:
-        print(f"Error in add_document: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+# Insert document rows in one batch and return their ids in order
+if USE_POSTGRES:
+    def insert_documents(c, rows):
+        if not rows:
+            return []
+        created = execute_values(c, f'INSERT INTO documents {DOCUMENT_INSERT_COLUMNS} VALUES %s RETURNING id',
+                                 rows, page_size=500, fetch=True)
+        return [row['id'] for row in created]
+else:
+    def insert_documents(c, rows):
+        # sqlite3's executemany can't report the new ids; these run in-process
+        # inside the same transaction, so there are no extra round trips to save
+        doc_ids = []
+        for row in rows:
+            c.execute(SQL_INSERT_DOCUMENT, row)
+            doc_ids.append(last_insert_id(c))
+        return doc_ids
+
+@db_endpoint
+def insert_document(conn, upload):
+    # Uploads arrive as multipart form data, links as JSON or form data
+    data = request.form if upload else (request.json if request.is_json else request.form)
+    c = conn.cursor()
+    c.execute(SQL_INSERT_DOCUMENT, document_row(data, upload))
+    doc_id = last_insert_id(c)
+    return jsonify({'id': doc_id}), 201
+
+@app.route('/api/documents/bulk', methods=['POST'])
+@db_endpoint
+def add_documents_bulk(conn):
+    # A JSON array of link documents, all created in one transaction
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return jsonify({'error': 'Expected a JSON array of documents'}), 400
+    c = conn.cursor()
+    doc_ids = insert_documents(c, [document_row(item) for item in items])
+    return jsonify({'ids': doc_ids}), 201
 
 @app.route('/api/documents/<int:doc_id>', methods=['PUT'])
-def update_document(doc_id):
-    def do_update():
-        data = request.json if request.is_json else request.form
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            if USE_POSTGRES:
-                c.execute('''UPDATE documents
-                            SET name=%s, description=%s, document_category=%s, version=%s,
-                                expiration_date=%s, tags=%s, company_id=%s, deal_id=%s, external_link=%s
-                            WHERE id=%s''',
-                         (data.get('name'), data.get('description'), data.get('document_category'),
-                          data.get('version'), data.get('expiration_date'), data.get('tags'),
-                          data.get('company_id') or None, data.get('deal_id') or None,
-                          data.get('external_link'), doc_id))
-            else:
-                c.execute('''UPDATE documents
-                            SET name=?, description=?, document_category=?, version=?,
-                                expiration_date=?, tags=?, company_id=?, deal_id=?, external_link=?
-                            WHERE id=?''',
-                         (data.get('name'), data.get('description'), data.get('document_category'),
-                          data.get('version'), data.get('expiration_date'), data.get('tags'),
-                          data.get('company_id') or None, data.get('deal_id') or None,
-                          data.get('external_link'), doc_id))
-            conn.commit()
-            return True
-        finally:
-            conn.close()
-
-    try:
-        execute_with_retry(do_update)
-        return jsonify({'success': True})
-    except Exception as e:
-        print(f"Error in update_document: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+@db_endpoint
+def update_document(conn, doc_id):
+    data = request.json if request.is_json else request.form
+    c = conn.cursor()
+    c.execute(SQL_UPDATE_DOCUMENT, document_fields(data) + (data.get('external_link'), doc_id))
+    forget_document_file(doc_id)
+    return jsonify({'success': True})
 
 @app.route('/api/documents/<int:doc_id>', methods=['DELETE'])
-def delete_document(doc_id):
-    def do_delete():
-        import os
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            # Get file path before deleting
-            if USE_POSTGRES:
-                c.execute('SELECT file_path FROM documents WHERE id = %s', (doc_id,))
-            else:
-                c.execute('SELECT file_path FROM documents WHERE id = ?', (doc_id,))
-            result = c.fetchone()
-
-            if result and result['file_path']:
-                # Delete physical file if it exists
-                file_path = result['file_path']
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-
-            # Delete database record
-            if USE_POSTGRES:
-                c.execute('DELETE FROM documents WHERE id=%s', (doc_id,))
-            else:
-                c.execute('DELETE FROM documents WHERE id=?', (doc_id,))
-            conn.commit()
-            return True
-        finally:
-            conn.close()
-
+@db_endpoint
+def delete_document(conn, doc_id):
+    c = conn.cursor()
+    # Get file path before deleting
+    c.execute(SQL_SELECT_DOCUMENT_FILE, (doc_id,))
+    result = c.fetchone()
+
+    if result and result['file_path']:
+        file_path = result['file_path']
+
+        @after_this_request
+        def remove_file_after_commit(response):
+            # Runs after db_endpoint has committed (or given up), so a failed
+            # delete never loses the file. The unlink itself waits until the
+            # response has been sent.
+            if response.status_code == 200:
+                response.call_on_close(lambda: remove_upload(file_path))
+            return response
+
+    # Delete database record
+    c.execute(SQL_DELETE_DOCUMENT, (doc_id,))
+    forget_document_file(doc_id)
+    return jsonify({'success': True})
+
+def remove_upload(file_path):
     try:
-        execute_with_retry(do_delete)
-        return jsonify({'success': True})
-    except Exception as e:
-        print(f"Error in delete_document: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+        os.remove(file_path)
+    except FileNotFoundError:
+        pass
 
 @app.route('/api/documents/<int:doc_id>/download', methods=['GET'])
 def download_document(doc_id):
-    def do_get():
-        conn = get_db()
-        try:
-            c = conn.cursor()
-            if USE_POSTGRES:
-                c.execute('SELECT file_path, name FROM documents WHERE id = %s', (doc_id,))
-            else:
-                c.execute('SELECT file_path, name FROM documents WHERE id = ?', (doc_id,))
-            result = c.fetchone()
-            return dict(result) if result else None
-        finally:
-            conn.close()
-
-    try:
-        doc = execute_with_retry(do_get)
-        if not doc or not doc['file_path']:
-            return jsonify({'error': 'Document not found'}), 404
-
-        return send_from_directory(os.path.dirname(doc['file_path']),
-                                  os.path.basename(doc['file_path']),
-                                  as_attachment=True,
-                                  download_name=doc['name'])
-    except Exception as e:
-        print(f"Error in download_document: {e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+    # Repeat downloads of a document skip the database entirely
+    cached = cached_document_file(doc_id)
+    if cached is None:
+        return download_uncached_document(doc_id)
+    return send_document(*cached)
+
+@db_endpoint
+def download_uncached_document(conn, doc_id):
+    c = conn.cursor()
+    c.execute(SQL_SELECT_DOCUMENT_FILE, (doc_id,))
+    doc = c.fetchone()
+    if not doc or not doc['file_path']:
+        return jsonify({'error': 'Document not found'}), 404
+    cache_document_file(doc_id, doc['file_path'], doc['name'])
+    return send_document(doc['file_path'], doc['name'])
+
+def send_document(file_path, name):
+    """Attachment response for a stored upload"""
+    if X_ACCEL_REDIRECT_PREFIX:
+        response = app.response_class()
+        response.headers['X-Accel-Redirect'] = X_ACCEL_REDIRECT_PREFIX + os.path.basename(file_path)
+        # Same filename handling as send_file: RFC 5987 form for non-ASCII names
+        if name.isascii():
+            names = {'filename': name}
+        else:
+            names = {'filename': name.encode('ascii', 'ignore').decode('ascii'),
+                     'filename*': "UTF-8''" + quote(name, safe="!#$&+^`|~")}
+        response.headers.set('Content-Disposition', 'attachment', **names)
+        # Let nginx pick the type from the file
+        del response.headers['Content-Type']
+        return response
+
+    return send_from_directory(os.path.dirname(file_path),
+                              os.path.basename(file_path),
+                              as_attachment=True,
+                              download_name=name,
+                              conditional=True)
 
 # ==================== SERVE HTML ====================
 
+# Assets aren't fingerprinted, so let browsers reuse them for a day at most
+ASSET_MAX_AGE = 86400  # seconds
+
 @app.route('/')
 def serve_index():
-    ensure_db_initialized()
-    try:
-        with open('index.html', 'r') as f:
-            return f.read(), 200, {'Content-Type': 'text/html'}
-    except Exception as e:
-        return f"Error: {str(e)}", 500
+    # Always revalidated, answered with 304 while index.html is unchanged
+    return send_from_directory(app.root_path, 'index.html', max_age=0)
 
 @app.route('/assets/<path:filename>')
 def serve_assets(filename):
-    try:
-        with open(f'assets/{filename}', 'rb') as f:
-            if filename.endswith('.png'):
-                return f.read(), 200, {'Content-Type': 'image/png'}
-            elif filename.endswith('.jpg'):
-                return f.read(), 200, {'Content-Type': 'image/jpeg'}
-            else:
-                return f.read(), 200, {'Content-Type': 'application/octet-stream'}
-    except Exception as e:
-        return f"Asset not found: {str(e)}", 404
+    return send_from_directory(os.path.join(app.root_path, 'assets'), filename, max_age=ASSET_MAX_AGE)
 
 if __name__ == '__main__':
     app.run(debug=False, port=3000, host='0.0.0.0')
\ No newline at end of file